@@ -1,8 +1,50 @@
-import requests
+import re
 import json
+import time
+import asyncio
+import inspect
 import logging
+import threading
+import weakref
 from tqdm import tqdm
 from config import Config, print_config_info
+from ollama_client import OllamaClient, create_client, awarm_up_model, run_sync, OllamaError, OllamaHTTPError, OllamaTimeoutError, OllamaUnavailableError
+from response_cache import ResponseCache, get_response_cache
+from syllabus_index import get_syllabus_index
+from metrics import record_generation
+from prompt_budget import estimate_tokens, truncate_to_tokens, output_tokens, get_num_ctx_sizer
+
+# 教案中由AI生成的全部字段（与 prompt_templates 的键一致）
+LESSON_FIELDS = ["单元教学目标", "教学重点", "教学难点", "教学活动", "作业布置", "教学资源", "教学反思", "教学评价"]
+
+# 流式进度事件中附带的最新文本长度
+STREAM_PREVIEW_CHARS = 40
+# 结构化模式一次生成全部字段时，进度事件使用的字段名
+STRUCTURED_PROGRESS_FIELD = "全部字段"
+
+# 推理模型输出的思考过程；被 num_predict 截断时可能没有结束标记
+_THINK_BLOCK = re.compile(r"<think>.*?(?:</think>|$)", re.S)
+
+
+def strip_thinking(text):
+    """
+    去掉推理模型输出的 <think>...</think> 思考过程
+    :param text: 模型输出
+    :return: (去掉思考过程后的文本, 去掉的字符数)
+    """
+    stripped = _THINK_BLOCK.sub("", text)
+    return stripped.lstrip(), len(text) - len(stripped)
+
+
+def field_instructions(template):
+    """
+    从单字段提示词模板得到该字段的撰写要求：去掉含占位符的课次信息行和空行
+    :param template: prompt_templates 中的模板
+    :return: 撰写要求文本
+    """
+    lines = (line.strip() for line in template.strip().splitlines())
+    return "\n".join(line for line in lines if line and "{" not in line)
+
 
 class AIGenerator:
     """AI生成引擎：调用本地Ollama模型生成各教案字段内容"""
@@ -15,15 +57,48 @@ class AIGenerator:
         # 从配置获取Ollama设置
         config = Config.validate_ollama_config()
         self.model_name = config["model"]
-        self.base_url = config["host"]
+        # 字段到模型的路由表，未列出的字段使用 model_name
+        self.field_models = {field: model for field, model in config["field_models"].items() if field in LESSON_FIELDS}
+        unknown = [field for field in config["field_models"] if field not in LESSON_FIELDS]
+        if unknown:
+            self.logger.warning(f"OLLAMA_FIELD_MODELS 中以下字段不存在，已忽略: {unknown}")
+        self.models = list(dict.fromkeys([self.model_name, *self.field_models.values()]))
+        self.hosts = config["hosts"]
+        self.base_url = self.hosts[0]
         self.api_url = config["url"]
         self.timeout = config["timeout"]
         self.max_retries = config["max_retries"]
+        self.field_concurrency = config["field_concurrency"]
+        self.keep_alive = config["keep_alive"]
+        self.think = config["think"]
+        self.syllabus_token_budget = Config.SYLLABUS_CONTEXT_TOKENS
+        self.client = create_client(self.hosts, self.max_retries)
+        self.cache = get_response_cache()
         
         # 打印配置信息
-        print_config_info()
+        print_config_info(config)
         self._check_ollama_status()
         
+        # 模型加载耗时单独统计：预热耗时，以及生成过程中Ollama报告的 load_duration 累计
+        self.model_load_seconds = None
+        self.load_seconds_total = 0.0
+        # prefix 模式下提示词评估的token统计（复用课次前缀节省的部分为估算值）
+        self.prompt_eval_stats = {"lessons": 0, "prompt_eval_tokens": 0, "saved_tokens": 0}
+        self._timing_lock = threading.Lock()
+        
+        # 相同请求去重：进行中的请求（按事件循环），以及批量计划中会重复出现的请求结果
+        self._async_inflight = weakref.WeakKeyDictionary()
+        self._planned = {}
+        self._shared_results = {}
+        self._dedup_lock = threading.Lock()
+        self.dedup_stats = {"deduplicated": 0}
+        # 各字段的实际输出统计：请求数、输出token数、达到 num_predict 上限的次数、去掉的思考过程字符数
+        self.field_stats = {}
+        # 预热在批量计划之后进行（见 BatchGenerator.arun），此时 num_ctx 已按全部课次的请求确定；
+        # 记录每个主机上的模型已按哪个 num_ctx 加载，同一档位不重复预热
+        self.warmup = config["warmup"]
+        self._warmed = {}
+        
         # 提示词模板
         self.prompt_templates = {
             "单元教学目标": """
@@ -130,46 +205,123 @@ class AIGenerator:
             """
         }
 
+        # 课次公共信息，单次请求生成多个字段时只出现一次
+        self.lesson_context_template = """
+课程：{课程名称}
+章节内容：{章节内容}
+课时：{课时}
+授课安排：第{week}周第{lesson}次课
+"""
+        
+        # 各字段的撰写要求（不含课次信息），与 lesson_context_template 组合使用；
+        # 由 prompt_templates 去掉课次信息行得到，逐字段生成和 structured/prefix 模式的要求始终一致
+        self.field_instructions = {field: field_instructions(template)
+                                   for field, template in self.prompt_templates.items()}
+        
+        # 各字段的生成参数，与 prompt_templates 对应：
+        # num_predict 限制输出长度，默认取该字段在 num_ctx 中的输出预留；stop 默认在模型开始撰写其他部分时截断；
+        # 列举类的短字段使用较低的 temperature，教学活动需要更多变化
+        self.field_profiles = {
+            "单元教学目标": {"temperature": 0.4},
+            "教学重点": {"temperature": 0.3},
+            "教学难点": {"temperature": 0.3},
+            "教学活动": {"temperature": 0.7},
+            "作业布置": {"temperature": 0.6},
+            "教学资源": {"temperature": 0.5},
+            "教学反思": {"temperature": 0.6},
+            "教学评价": {"temperature": 0.5}
+        }
+        
+        # prefix 模式的系统消息：课次信息放在最前面，同一节课的各字段请求共享这段前缀
+        self.lesson_prefix_template = """你是高职院校{课程名称}课程教师，正在为以下课次撰写教案，之后会逐项提出撰写要求。
+{context}
+只输出所要求部分的正文，不要添加标题或额外说明。"""
+        
+        # 生成模式：per_field 每个字段单独请求；structured 每节课一次请求生成全部字段；
+        # prefix 同一节课的字段依次通过 /api/chat 请求，复用已评估的课次前缀
+        self.generation_mode = config["generation_mode"]
+        
     def _check_ollama_status(self):
-        """检查Ollama API服务的真实状态"""
-        print(f"正在检查Ollama服务状态 ({self.base_url})...")
-        try:
-            # 请求一个核心API端点，而不是根页面，以确保API服务正常
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
-            response.raise_for_status()  # 如果状态码不是2xx，则会引发HTTPError
-            print("Ollama API 服务连接成功，状态正常。")
-        except requests.exceptions.RequestException as e:
+        """检查Ollama API服务的真实状态；配置了多个地址时至少要有一个可用"""
+        failed = []
+        for host in self.hosts:
+            print(f"正在检查Ollama服务状态 ({host})...")
+            try:
+                # 请求一个核心API端点，而不是根页面，以确保API服务正常
+                OllamaClient(host).get("/api/tags", timeout=5)
+                print("Ollama API 服务连接成功，状态正常。")
+            except OllamaError as e:
+                failed.append((host, e))
+        
+        if failed and len(failed) < len(self.hosts):
+            for host, e in failed:
+                print(f"警告：Ollama服务 {host} 无法连接（{e}），生成时该地址连续失败后会被暂时剔除。")
+            return
+        for host, e in failed:
             print(f"\n错误：无法连接到 Ollama API 服务。")
-            print(f"请求地址: {self.base_url}/api/tags")
+            print(f"请求地址: {host}/api/tags")
             print(f"错误详情: {e}")
+        if failed:
             print("\n请执行以下检查：")
             print("1. 确认 Ollama 应用正在您的电脑上运行。")
             print("2. 确认 Ollama 服务没有被防火墙或代理阻止。")
             print("3. 尝试更新 Ollama 到最新版本，或重新安装。")
             exit(1)
 
+    def warm_up(self):
+        """预热模型（同步调用），在新的事件循环中运行 awarm_up"""
+        return run_sync(self.awarm_up())
+    
+    async def awarm_up(self):
+        """
+        预热模型：在每个Ollama主机上同时加载用到的全部模型并设置 keep_alive
+        模型按当前的 num_ctx 档位加载，应在批量计划（plan_batch）提升档位之后调用，否则第一个请求会导致模型重新加载
+        :return: 最慢主机的模型加载耗时（秒），全部失败时为None
+        """
+        async def load(host, model, num_ctx):
+            try:
+                seconds = await awarm_up_model(host, model, self.keep_alive, num_ctx)
+            except OllamaError as e:
+                print(f"警告：在 {host} 上预热模型 {model} 失败: {e}")
+                return None
+            self._warmed[(host, model)] = num_ctx
+            return seconds
+        
+        # 按字段路由到多个模型时，每个模型都需要预热；已按相同档位加载过的跳过
+        targets = [(host, model, get_num_ctx_sizer(model).current) for host in self.hosts for model in self.models]
+        targets = [target for target in targets if self._warmed.get(target[:2]) != target[2]]
+        if not targets:
+            return self.model_load_seconds
+        print(f"正在预热模型 {', '.join(self.models)} (num_ctx={max(t[2] for t in targets)}, "
+              f"keep_alive={self.keep_alive})...")
+        durations = [d for d in await asyncio.gather(*(load(*target) for target in targets)) if d is not None]
+        if durations:
+            self.model_load_seconds = max(durations)
+            print(f"模型预热完成，加载耗时 {self.model_load_seconds:.2f}s")
+        return self.model_load_seconds
+    
+    def _record_timing(self, result):
+        """累计Ollama响应中的模型加载耗时（纳秒）"""
+        load_duration = result.get('load_duration')
+        if load_duration:
+            with self._timing_lock:
+                self.load_seconds_total += load_duration / 1e9
+    
     def get_local_models(self):
         """获取本地已下载的模型列表"""
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
-            response.raise_for_status()
-            models = response.json().get('models', [])
+            models = self.client.get("/api/tags", timeout=5).get('models', [])
             return [m['name'] for m in models]
         except Exception:
             return ["无法获取模型列表"]
     
-    def generate_content(self, prompt_type, **kwargs):
+    def _render_prompt(self, prompt_type, **kwargs):
         """
-        生成指定类型的内容
+        用课程数据填充提示词模板
         :param prompt_type: 提示词类型
         :param kwargs: 填充提示词的参数
-        :return: 生成的内容
+        :return: 完整的提示词
         """
-        print(f"=== AI generate_content ===")
-        print(f"prompt_type: {prompt_type}")
-        print(f"kwargs keys: {kwargs.keys() if kwargs else 'None'}")
-        print(f"lesson_data: {kwargs.get('lesson_data', 'Not found')}")
-        
         # 获取提示词模板
         if prompt_type not in self.prompt_templates:
             raise ValueError(f"不支持的提示词类型: {prompt_type}")
@@ -177,15 +329,7 @@ class AIGenerator:
         # 填充提示词
         try:
             # 构建格式化参数
-            format_params = {}
-            
-            # 添加lesson_data中的所有字段
-            if 'lesson_data' in kwargs:
-                format_params.update(kwargs['lesson_data'])
-            # 添加其他参数
-            for key, value in kwargs.items():
-                if key != 'lesson_data':
-                    format_params[key] = value
+            format_params = self._format_params(**kwargs)
             
             prompt = self.prompt_templates[prompt_type].format(**format_params)
         except KeyError as e:
@@ -196,43 +340,614 @@ class AIGenerator:
             self.logger.error("Please check your Excel file contains the required column for course name")
             raise
         
-        # 构造请求数据
-        data = {
-            "model": self.model_name,
+        excerpt = self._syllabus_excerpt(estimate_tokens(prompt), **kwargs)
+        if excerpt:
+            prompt = f"{prompt.rstrip()}\n\n{excerpt}\n"
+        return prompt
+    
+    def _format_params(self, **kwargs):
+        """
+        构建填充提示词的参数：lesson_data 中的字段加上其他参数，过长的章节内容截断到 PROMPT_CHAPTER_TOKENS
+        """
+        format_params = dict(kwargs.get('lesson_data') or {})
+        format_params.update({k: v for k, v in kwargs.items() if k != 'lesson_data'})
+        chapter = format_params.get('章节内容')
+        if isinstance(chapter, str):
+            format_params['章节内容'], truncated = truncate_to_tokens(chapter, Config.PROMPT_CHAPTER_TOKENS)
+            if truncated:
+                self.logger.info(f"章节内容约 {estimate_tokens(chapter)} tokens，"
+                                 f"已截断到 {Config.PROMPT_CHAPTER_TOKENS} tokens")
+        return format_params
+    
+    def _syllabus_excerpt(self, used_tokens=0, **kwargs):
+        """
+        从教学大纲中检索与本节课章节内容相关的片段
+        :param used_tokens: 提示词其余部分已占用的token数，节选不超过 PROMPT_MAX_TOKENS 的剩余部分
+        :param kwargs: 填充提示词的参数，使用其中的 syllabus_data 和 lesson_data
+        :return: 带标题的大纲节选，没有大纲或没有相关内容时为空字符串
+        """
+        budget = min(self.syllabus_token_budget, Config.PROMPT_MAX_TOKENS - used_tokens)
+        if budget <= 0:
+            return ""
+        index = get_syllabus_index(kwargs.get('syllabus_data'))
+        query = (kwargs.get('lesson_data') or {}).get('章节内容', '')
+        if index is None or not query:
+            return ""
+        excerpt = index.select(str(query), budget)
+        return f"参考教学大纲（与本节课相关的节选）：\n{excerpt}" if excerpt else ""
+    
+    def _model_for(self, field):
+        """
+        字段使用的模型
+        :param field: 字段名；一次生成多个字段（列表）时使用 model_name
+        """
+        if isinstance(field, str):
+            return self.field_models.get(field, self.model_name)
+        return self.model_name
+    
+    def _num_ctx_options(self, prompt_tokens, fields, label, log=True):
+        """
+        选择足够容纳提示词和输出的最小 num_ctx，每个模型的档位单独记录
+        :param prompt_tokens: 提示词的估算token数
+        :param fields: 本次请求生成的字段，用于确定输出预留和模型
+        :param label: 日志中显示的名称
+        :param log: 是否输出日志（批量计划时不输出）
+        :return: 请求的 options
+        """
+        reserve = output_tokens(fields)
+        num_ctx, overflow = get_num_ctx_sizer(self._model_for(fields)).pick(prompt_tokens, reserve)
+        if not log:
+            return {"num_ctx": num_ctx}
+        self.logger.info(f"{label}: 提示词约 {prompt_tokens} tokens，输出预留 {reserve}，num_ctx={num_ctx}")
+        if overflow:
+            self.logger.warning(f"{label}: 提示词和输出预留超过最大的 num_ctx 档位 {num_ctx}，输出可能被截断")
+        return {"num_ctx": num_ctx}
+    
+    def _build_payload(self, prompt, fields, log=True):
+        """
+        构造 /api/generate 请求数据
+        :param fields: 本次请求生成的字段（字段名或列表），用于确定 num_ctx
+        :param log: 是否输出 num_ctx 日志
+        """
+        label = fields if isinstance(fields, str) else STRUCTURED_PROGRESS_FIELD
+        options = self._num_ctx_options(estimate_tokens(prompt), fields, label, log)
+        # 结构化模式不限制输出长度：截断的JSON无法解析，会导致全部字段重新生成
+        if isinstance(fields, str):
+            options.update(self._field_options(fields))
+        return {
+            "model": self._model_for(fields),
             "prompt": prompt,
-            "stream": False
+            "stream": False,
+            "think": self.think,
+            "keep_alive": self.keep_alive,
+            "options": options
         }
-        
-        try:
-            # 调用Ollama API
-            response = requests.post(f"{self.base_url}/api/generate", json=data, timeout=180)
-            response.raise_for_status()
-            
-            # 解析响应
-            result = response.json()
-            return result.get('response', '').strip()
-        except requests.exceptions.HTTPError as e:
+    
+    def _field_options(self, field):
+        """
+        字段的生成参数：默认的 num_predict 和 stop 加上 field_profiles 中的设置
+        :param field: 字段名
+        :return: 请求 options 中的生成参数
+        """
+        options = {
+            "num_predict": output_tokens(field),
+            "stop": [f"【{other}】" for other in LESSON_FIELDS if other != field]
+        }
+        options.update(self.field_profiles.get(field, {}))
+        return options
+    
+    def _handle_error(self, prompt_type, error):
+        """输出Ollama调用错误，返回写入教案的占位文本"""
+        if isinstance(error, OllamaHTTPError):
             # 特别处理404错误，很可能是模型名称不对
-            if e.response.status_code == 404:
+            if error.status_code == 404:
                 try:
-                    error_detail = e.response.json().get('error', '')
+                    error_detail = json.loads(error.body).get('error', '')
                     if 'model' in error_detail and 'not found' in error_detail:
-                        tqdm.write(f"\n[AI生成错误] 模型 '{self.model_name}' 未在Ollama中找到。")
+                        tqdm.write(f"\n[AI生成错误] 模型 '{self._model_for(prompt_type)}' 未在Ollama中找到。")
                         tqdm.write(f"  > 您本地已有的模型: {self.get_local_models()}")
-                        tqdm.write(f"  > 请将 docker-compose.yml 或环境变量 OLLAMA_MODEL 的值修改为以上列表中的一个。")
+                        tqdm.write(f"  > 请将 docker-compose.yml 或环境变量 OLLAMA_MODEL / OLLAMA_FIELD_MODELS 中的模型修改为以上列表中的一个。")
                     else:
-                        tqdm.write(f"[AI生成错误] 调用Ollama API时出错 (404 Not Found): {e}")
+                        tqdm.write(f"[AI生成错误] 调用Ollama API时出错 (404 Not Found): {error}")
                 except json.JSONDecodeError:
-                     tqdm.write(f"[AI生成错误] 调用Ollama API时出错 (404 Not Found), 且无法解析错误响应: {e}")
+                     tqdm.write(f"[AI生成错误] 调用Ollama API时出错 (404 Not Found), 且无法解析错误响应: {error}")
             else:
-                tqdm.write(f"[AI生成错误] 调用Ollama API时发生HTTP错误: {e}")
+                tqdm.write(f"[AI生成错误] 调用Ollama API时发生HTTP错误: {error}")
             return f"[{prompt_type} 生成失败]"
-        except requests.exceptions.Timeout:
+        if isinstance(error, OllamaTimeoutError):
             tqdm.write(f"    > 生成 {prompt_type} 超时。请检查Ollama服务或模型是否正常。")
             return f"[{prompt_type} 生成超时]"
-        except requests.exceptions.RequestException as e:
-            tqdm.write(f"调用Ollama API时发生网络错误: {e}")
-            return ""
-        except json.JSONDecodeError as e:
-            tqdm.write(f"解析API响应时出错: {e}")
-            return ""
\ No newline at end of file
+        if isinstance(error, OllamaUnavailableError):
+            tqdm.write(f"    > 跳过 {prompt_type}：{error}")
+            return f"[{prompt_type} 生成失败]"
+        tqdm.write(f"调用Ollama API时发生错误: {error}")
+        return ""
+    
+    @staticmethod
+    def _raw_response_text(result):
+        """取出响应文本：/api/generate 为 response，/api/chat 为 message.content"""
+        if 'message' in result:
+            return result['message'].get('content', '')
+        return result.get('response', '')
+    
+    @classmethod
+    def _response_text(cls, result):
+        """取出去掉思考过程的响应文本"""
+        return strip_thinking(cls._raw_response_text(result))[0]
+    
+    def _record_field_usage(self, field, data, result):
+        """累计字段的实际输出token数；输出达到 num_predict 上限时给出提示"""
+        think_chars = strip_thinking(self._raw_response_text(result))[1]
+        capped = result.get('done_reason') == 'length'
+        with self._timing_lock:
+            stats = self.field_stats.setdefault(field, {"model": data.get("model"), "requests": 0, "eval_tokens": 0,
+                                                        "capped": 0, "think_chars": 0})
+            stats["requests"] += 1
+            stats["eval_tokens"] += result.get('eval_count') or 0
+            stats["capped"] += capped
+            stats["think_chars"] += think_chars
+        if capped:
+            self.logger.warning(f"{field}: 输出达到 num_predict 上限 {data['options'].get('num_predict')}，内容可能不完整")
+        if think_chars:
+            self.logger.info(f"{field}: 已去掉 {think_chars} 个字符的思考过程")
+    
+    def field_usage_report(self):
+        """
+        各字段的输出统计
+        :return: {字段: {"model", "requests", "eval_tokens", "avg_eval_tokens", "num_predict", "capped", "think_chars"}}
+        """
+        with self._timing_lock:
+            report = {field: dict(stats) for field, stats in self.field_stats.items()}
+        for field, stats in report.items():
+            stats["avg_eval_tokens"] = round(stats["eval_tokens"] / stats["requests"]) if stats["requests"] else 0
+            stats["num_predict"] = self._field_options(field)["num_predict"] if field in self.field_profiles else None
+        return report
+    
+    def _cache_lookup(self, data, use_cache, refresh_cache):
+        """
+        查询响应缓存
+        :return: (缓存键, 缓存的响应)；不使用缓存时键为None
+        """
+        if self.cache is None or not use_cache:
+            return None, None
+        key = self.cache.make_key(data)
+        if refresh_cache:
+            self.cache.invalidate(key)
+            return key, None
+        return key, self.cache.get(key)
+    
+    def _cache_store(self, key, result):
+        """写入响应缓存，空结果不缓存"""
+        if key is not None and self._response_text(result).strip():
+            # context 是模型内部状态，体积大且不需要复用
+            self.cache.put(key, {k: v for k, v in result.items() if k != 'context'})
+    
+    def _progress_tracker(self, prompt_type, on_progress):
+        """
+        把流式文本片段转换为字段进度事件
+        :param prompt_type: 字段名
+        :param on_progress: 进度回调，参数为事件字典；异步路径中可以是协程函数
+        :return: 传给 OllamaClient.astream 的 on_chunk 回调
+        """
+        state = {"start": time.perf_counter(), "ttft": None, "chars": 0, "chunks": 0, "tail": ""}
+        
+        def on_chunk(piece, chunk):
+            if piece:
+                if state["ttft"] is None:
+                    state["ttft"] = time.perf_counter() - state["start"]
+                    self.logger.info(f"{prompt_type} 首个token耗时 {state['ttft']:.2f}s")
+                state["chars"] += len(piece)
+                state["chunks"] += 1
+                state["tail"] = (state["tail"] + piece)[-STREAM_PREVIEW_CHARS:]
+            return on_progress({
+                "field": prompt_type,
+                "chars": state["chars"],
+                "chunks": state["chunks"],
+                "preview": state["tail"],
+                "ttft": state["ttft"],
+                "done": bool(chunk.get("done"))
+            })
+        return on_chunk
+    
+    @classmethod
+    def _cached_progress(cls, prompt_type, result):
+        """命中缓存时的进度事件"""
+        text = cls._response_text(result)
+        return {"field": prompt_type, "chars": len(text), "chunks": 0,
+                "preview": text[-STREAM_PREVIEW_CHARS:], "ttft": 0.0, "done": True, "cached": True}
+    
+    async def _arequest(self, data, use_cache, refresh_cache, on_progress, prompt_type, path):
+        """查询缓存，未命中时请求Ollama并写入缓存"""
+        key, cached = self._cache_lookup(data, use_cache, refresh_cache)
+        if cached is not None:
+            if on_progress:
+                outcome = on_progress(self._cached_progress(prompt_type, cached))
+                if inspect.isawaitable(outcome):
+                    await outcome
+            return dict(cached, cached=True)
+        if on_progress:
+            result = await self.client.astream(path, data, self._progress_tracker(prompt_type, on_progress))
+        else:
+            result = await self.client.apost(path, data)
+        self._record_timing(result)
+        self._record_field_usage(prompt_type, data, result)
+        record_generation(prompt_type, data.get("model"), result)
+        self._cache_store(key, result)
+        return result
+    
+    def _consume_planned(self, key):
+        """批量计划中的请求每被使用一次计数减一，所有课次都用过后释放保留的结果（调用方持有 _dedup_lock）"""
+        remaining = self._planned.get(key)
+        if remaining is None:
+            return
+        if remaining <= 1:
+            del self._planned[key]
+            self._shared_results.pop(key, None)
+        else:
+            self._planned[key] = remaining - 1
+    
+    def _take_shared(self, key):
+        """取出批量计划中已生成过的相同请求的结果，没有时返回None"""
+        with self._dedup_lock:
+            result = self._shared_results.get(key)
+            if result is not None:
+                self._consume_planned(key)
+                self.dedup_stats["deduplicated"] += 1
+            return result
+    
+    def _share_result(self, key, result):
+        """请求完成：批量中还有其他课次需要相同的请求时保留结果（调用方持有 _dedup_lock）"""
+        self._consume_planned(key)
+        if key in self._planned:
+            self._shared_results[key] = {k: v for k, v in result.items() if k != 'context'}
+    
+    def _join_inflight(self, key):
+        """等待进行中的相同请求的一方：计入去重统计"""
+        with self._dedup_lock:
+            self._consume_planned(key)
+            self.dedup_stats["deduplicated"] += 1
+    
+    def _shared_progress(self, prompt_type, result, on_progress):
+        """复用相同请求的结果时只发送一次完成事件"""
+        if on_progress:
+            return on_progress(dict(self._cached_progress(prompt_type, result), deduplicated=True))
+    
+    async def _apost_generate(self, data, use_cache=True, refresh_cache=False, on_progress=None, prompt_type=None,
+                              path="/api/generate"):
+        """
+        调用 /api/generate（或 path 指定的接口），命中缓存时直接返回缓存的响应（带 cached 标记）
+        完全相同的请求只发送一次：正在进行中的相同请求直接等待其结果，批量计划中重复的请求复用已生成的结果
+        :param on_progress: 提供时以流式方式请求，并逐段回调字段进度，可以是协程函数
+        """
+        key = ResponseCache.make_key(data)
+        shared = self._take_shared(key)
+        if shared is None:
+            inflight = self._async_inflight.setdefault(asyncio.get_running_loop(), {})
+            future = inflight.get(key)
+            if future is None:
+                future = inflight[key] = asyncio.get_running_loop().create_future()
+                try:
+                    result = await self._arequest(data, use_cache, refresh_cache, on_progress, prompt_type, path)
+                except BaseException as e:
+                    del inflight[key]
+                    future.set_exception(e if isinstance(e, Exception) else OllamaError("相同的请求已取消"))
+                    # 没有其他等待方时避免 "exception was never retrieved" 警告
+                    future.exception()
+                    raise
+                # 先发布结果再移除进行中的记录，并且在同一个锁内完成：
+                # 否则移除之后、发布之前到达的相同请求既看不到进行中的请求，也取不到共享的结果，会重复发送
+                with self._dedup_lock:
+                    self._share_result(key, result)
+                    future.set_result(result)
+                    del inflight[key]
+                return result
+            # shield：等待方被取消时不影响正在进行的请求
+            shared = await asyncio.shield(future)
+            self._join_inflight(key)
+        
+        outcome = self._shared_progress(prompt_type, shared, on_progress)
+        if inspect.isawaitable(outcome):
+            await outcome
+        return dict(shared, cached=True)
+    
+    def _lesson_payloads(self, fields, **kwargs):
+        """
+        按 generation_mode 构造一节课要发送的全部请求数据（不发送），用于批量计划
+        :param fields: 字段列表
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: 请求数据列表
+        """
+        if self.generation_mode == "structured":
+            prompt, schema = self._render_structured_prompt(fields, **kwargs)
+            return [dict(self._build_payload(prompt, fields, log=False), format=schema)]
+        if self.generation_mode == "prefix":
+            system = self._render_prefix(fields, **kwargs)
+            return [self._build_prefixed_payload(system, field, log=False) for field in fields]
+        return [self._build_payload(self._render_prompt(field, **kwargs), field, log=False) for field in fields]
+    
+    def plan_batch(self, fields, schedule_data, syllabus_data=None):
+        """
+        批量生成前渲染所有课次的请求，找出完全相同的请求：
+        每个不同的请求只生成一次，结果分发给所有需要它的课次
+        :param fields: 字段列表
+        :param schedule_data: 教学进度表数据
+        :param syllabus_data: 教学大纲数据（可选）
+        :return: {"requests": 请求总数, "unique": 去重后的请求数}
+        """
+        counts = {}
+        for lesson_data in schedule_data:
+            for data in self._lesson_payloads(list(fields), lesson_data=lesson_data, syllabus_data=syllabus_data):
+                key = ResponseCache.make_key(data)
+                counts[key] = counts.get(key, 0) + 1
+        with self._dedup_lock:
+            self._planned = {key: count for key, count in counts.items() if count > 1}
+            self._shared_results = {}
+        plan = {"requests": sum(counts.values()), "unique": len(counts)}
+        self.logger.info(f"批量计划: 共 {plan['requests']} 个请求，去重后 {plan['unique']} 个")
+        return plan
+    
+    def clear_plan(self):
+        """批量结束后释放计划和保留的结果"""
+        with self._dedup_lock:
+            self._planned = {}
+            self._shared_results = {}
+    
+    def generate_content(self, prompt_type, **kwargs):
+        """
+        生成指定类型的内容（同步调用），在新的事件循环中运行 agenerate_content
+        :param prompt_type: 提示词类型
+        :param kwargs: 同 agenerate_content
+        :return: 生成的内容
+        """
+        return run_sync(self.agenerate_content(prompt_type, **kwargs))
+    
+    async def agenerate_content(self, prompt_type, use_cache=True, refresh_cache=False, on_progress=None,
+                                raise_on_error=False, **kwargs):
+        """
+        生成指定类型的内容，等待Ollama响应时不阻塞事件循环
+        :param prompt_type: 提示词类型
+        :param use_cache: 是否读写响应缓存
+        :param refresh_cache: 丢弃已有缓存并重新生成
+        :param on_progress: 提供时以流式方式生成，可以是协程函数
+        :param raise_on_error: 重试后仍失败时抛出 OllamaError，而不是返回占位文本
+        :param kwargs: 填充提示词的参数
+        :return: 生成的内容
+        """
+        prompt = self._render_prompt(prompt_type, **kwargs)
+        data = self._build_payload(prompt, prompt_type)
+        
+        try:
+            result = await self._apost_generate(data, use_cache, refresh_cache, on_progress, prompt_type)
+            return self._response_text(result).strip()
+        except OllamaError as e:
+            placeholder = self._handle_error(prompt_type, e)
+            if raise_on_error:
+                raise
+            return placeholder
+    
+    def _check_fields(self, fields):
+        for field in fields:
+            if field not in self.field_instructions:
+                raise ValueError(f"不支持的提示词类型: {field}")
+    
+    def _render_lesson_context(self, reserved_tokens=0, **kwargs):
+        """
+        渲染课次公共信息
+        :param reserved_tokens: 提示词中其余部分（字段要求等）预计占用的token数
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: (填充参数字典, 课次信息文本)
+        """
+        format_params = self._format_params(**kwargs)
+        context = self.lesson_context_template.format(**format_params)
+        excerpt = self._syllabus_excerpt(estimate_tokens(context) + reserved_tokens, **kwargs)
+        if excerpt:
+            context = f"{context.rstrip()}\n{excerpt}\n"
+        return format_params, context
+    
+    def _render_structured_prompt(self, fields, **kwargs):
+        """
+        构造一次生成多个字段的提示词，课次信息只出现一次
+        :param fields: 字段列表
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: (提示词, JSON Schema)
+        """
+        self._check_fields(fields)
+        sections = "\n\n".join(f"【{field}】\n{self.field_instructions[field]}" for field in fields)
+        format_params, context = self._render_lesson_context(estimate_tokens(sections), **kwargs)
+        
+        prompt = (
+            f"作为高职院校{format_params['课程名称']}课程教师，请为以下课次撰写教案的各个部分。\n"
+            f"{context}\n"
+            f"请按下列要求分别撰写，并输出一个JSON对象：键为各部分名称，值为该部分的纯文本内容。\n\n"
+            f"{sections}\n"
+        )
+        schema = {
+            "type": "object",
+            "properties": {field: {"type": "string"} for field in fields},
+            "required": list(fields)
+        }
+        return prompt, schema
+    
+    def _split_structured_response(self, fields, result):
+        """
+        把结构化响应拆回各字段
+        :return: (字段内容字典, 需要单独重新生成的字段列表)
+        """
+        try:
+            parsed = json.loads(self._response_text(result))
+        except json.JSONDecodeError:
+            parsed = None
+        if not isinstance(parsed, dict):
+            self.logger.warning("结构化响应不是有效的JSON对象，全部字段改为逐个生成")
+            return {}, list(fields)
+        
+        contents, malformed = {}, []
+        for field in fields:
+            value = parsed.get(field)
+            if isinstance(value, list) and all(isinstance(item, str) for item in value):
+                value = "\n".join(value)
+            if isinstance(value, str) and value.strip():
+                contents[field] = value.strip()
+            else:
+                malformed.append(field)
+        if malformed:
+            self.logger.warning(f"结构化响应中以下字段缺失或格式错误，改为逐个生成: {malformed}")
+        return contents, malformed
+    
+    async def agenerate_structured(self, fields=None, use_cache=True, refresh_cache=False, on_progress=None,
+                                   raise_on_error=False, **kwargs):
+        """
+        一次请求生成同一节课的全部字段（Ollama JSON Schema 输出），格式错误的字段单独重新生成
+        :param fields: 字段列表，默认为全部教案字段
+        :param use_cache: 是否读写响应缓存
+        :param refresh_cache: 丢弃已有缓存并重新生成
+        :param on_progress: 提供时以流式方式生成，可以是协程函数，进度事件的字段名为 STRUCTURED_PROGRESS_FIELD
+        :param raise_on_error: 服务熔断或逐个生成重试后仍失败时抛出 OllamaError，而不是返回占位文本
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: 字段到生成内容的字典，顺序与 fields 一致
+        """
+        fields = list(fields or LESSON_FIELDS)
+        prompt, schema = self._render_structured_prompt(fields, **kwargs)
+        data = self._build_payload(prompt, fields)
+        data["format"] = schema
+        
+        try:
+            result = await self._apost_generate(data, use_cache, refresh_cache, on_progress, STRUCTURED_PROGRESS_FIELD)
+            contents, malformed = self._split_structured_response(fields, result)
+        except OllamaUnavailableError:
+            # 服务已熔断，逐个生成也只会快速失败
+            if raise_on_error:
+                raise
+            contents, malformed = {}, fields
+        except OllamaError as e:
+            self.logger.warning(f"结构化生成失败，改为逐个生成: {e}")
+            contents, malformed = {}, fields
+        
+        if malformed:
+            contents.update(await self.agenerate_fields(malformed, use_cache=use_cache, refresh_cache=refresh_cache,
+                                                        on_progress=on_progress, raise_on_error=raise_on_error,
+                                                        **kwargs))
+        return {field: contents[field] for field in fields}
+    
+    def _build_prefixed_payload(self, system, field, log=True):
+        """构造 prefix 模式的 /api/chat 请求：系统消息为课次前缀，用户消息为字段要求"""
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": f"请撰写本节课的【{field}】。\n{self.field_instructions[field]}"}
+        ]
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        options = self._num_ctx_options(prompt_tokens, field, field, log)
+        options.update(self._field_options(field))
+        return {
+            "model": self._model_for(field),
+            "messages": messages,
+            "stream": False,
+            "think": self.think,
+            "keep_alive": self.keep_alive,
+            "options": options
+        }
+    
+    def _render_prefix(self, fields, **kwargs):
+        """校验字段并渲染同一节课共享的系统消息"""
+        self._check_fields(fields)
+        longest = max(estimate_tokens(self.field_instructions[field]) for field in fields)
+        format_params, context = self._render_lesson_context(longest, **kwargs)
+        return self.lesson_prefix_template.format(context=context.strip(), **format_params)
+    
+    def _report_prefix_savings(self, lesson_data, usage):
+        """
+        统计一节课复用前缀节省的提示词评估量
+        以本节课第一次实际请求（前缀尚未缓存）的 token/字符 比例估算后续请求完整评估所需的token数，
+        与Ollama返回的 prompt_eval_count 之差即为节省量
+        :param usage: [(请求数据, 响应), ...]，按请求顺序
+        :return: 统计字典
+        """
+        fresh = [(data, result) for data, result in usage
+                 if not result.get('cached') and result.get('prompt_eval_count')]
+        evaluated = sum(result['prompt_eval_count'] for _, result in fresh)
+        saved = 0
+        if fresh:
+            chars = lambda data: sum(len(m["content"]) for m in data["messages"])
+            first_data, first_result = fresh[0]
+            tokens_per_char = first_result['prompt_eval_count'] / max(1, chars(first_data))
+            for data, result in fresh[1:]:
+                saved += max(0, round(tokens_per_char * chars(data)) - result['prompt_eval_count'])
+        
+        stats = {"prompt_eval_tokens": evaluated, "saved_tokens": saved,
+                 "saved_ratio": saved / (evaluated + saved) if evaluated + saved else 0.0}
+        with self._timing_lock:
+            self.prompt_eval_stats["lessons"] += 1
+            self.prompt_eval_stats["prompt_eval_tokens"] += evaluated
+            self.prompt_eval_stats["saved_tokens"] += saved
+        label = f"第{lesson_data.get('week')}周第{lesson_data.get('lesson')}次课" if lesson_data else "本节课"
+        self.logger.info(f"{label} 提示词评估 {evaluated} tokens，复用课次前缀约节省 {saved} tokens "
+                         f"({stats['saved_ratio']:.0%})")
+        return stats
+    
+    async def agenerate_prefixed(self, fields=None, use_cache=True, refresh_cache=False, on_progress=None,
+                                 raise_on_error=False, **kwargs):
+        """
+        依次生成同一节课的各字段，所有请求以相同的课次系统消息开头，
+        Ollama可以复用上一次请求已评估的前缀，只需评估新的字段要求
+        :param fields: 字段列表，默认为全部教案字段
+        :param use_cache: 是否读写响应缓存
+        :param refresh_cache: 丢弃已有缓存并重新生成
+        :param on_progress: 提供时以流式方式生成，可以是协程函数
+        :param raise_on_error: 重试后仍失败时抛出 OllamaError，而不是返回占位文本
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: 字段到生成内容的字典，顺序与 fields 一致
+        """
+        fields = list(fields or LESSON_FIELDS)
+        system = self._render_prefix(fields, **kwargs)
+        contents, usage = {}, []
+        # 同一节课的字段必须依次请求，前缀评估完成后后续请求才能复用
+        for field in fields:
+            data = self._build_prefixed_payload(system, field)
+            try:
+                result = await self._apost_generate(data, use_cache, refresh_cache, on_progress, field,
+                                                    path="/api/chat")
+            except OllamaError as e:
+                placeholder = self._handle_error(field, e)
+                if raise_on_error:
+                    raise
+                contents[field] = placeholder
+                continue
+            contents[field] = self._response_text(result).strip()
+            usage.append((data, result))
+        self._report_prefix_savings(kwargs.get('lesson_data'), usage)
+        return contents
+    
+    async def agenerate_lesson(self, fields=None, **kwargs):
+        """
+        按 generation_mode 生成一节课的全部字段
+        :param fields: 字段列表，默认为全部教案字段
+        :param kwargs: 传给具体生成方法的参数
+        :return: 字段到生成内容的字典
+        """
+        if self.generation_mode == "structured":
+            return await self.agenerate_structured(fields, **kwargs)
+        if self.generation_mode == "prefix":
+            return await self.agenerate_prefixed(fields, **kwargs)
+        return await self.agenerate_fields(fields, **kwargs)
+    
+    async def agenerate_fields(self, fields=None, max_workers=None, **kwargs):
+        """
+        并发生成同一节课的多个字段，单节课的耗时接近最慢的字段，而不是所有字段之和
+        :param fields: 字段列表，默认为全部教案字段
+        :param max_workers: 同时进行的请求数上限，默认使用 OLLAMA_FIELD_CONCURRENCY
+        :param kwargs: 填充提示词的参数，同 agenerate_content
+        :return: 字段到生成内容的字典，顺序与 fields 一致
+        """
+        fields = list(fields or LESSON_FIELDS)
+        limit = asyncio.Semaphore(max(1, max_workers or self.field_concurrency))
+        
+        async def generate(field):
+            async with limit:
+                return await self.agenerate_content(field, **kwargs)
+        
+        # 等所有字段结束后再抛出第一个错误，避免遗留未等待的请求
+        contents = await asyncio.gather(*(generate(field) for field in fields), return_exceptions=True)
+        for content in contents:
+            if isinstance(content, BaseException):
+                raise content
+        return dict(zip(fields, contents))
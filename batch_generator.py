@@ -0,0 +1,324 @@
+import os
+import time
+import asyncio
+import inspect
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from config import Config
+from ai_generator import LESSON_FIELDS
+from ollama_client import OllamaUnavailableError, async_client_session
+
+logger = logging.getLogger(__name__)
+
+
+def lesson_label(lesson_data):
+    """课次的显示名称，如 第1周第2次课"""
+    return f"第{lesson_data['week']}周第{lesson_data['lesson']}次课"
+
+
+def lesson_filename(lesson_data):
+    """课次对应的教案文件名"""
+    return f"{lesson_label(lesson_data)}教案.docx"
+
+
+class BackendOutage:
+    """记录Ollama熔断导致的批量暂停：课次退回队列，冷却结束后再提交"""
+
+    def __init__(self, timeout=None):
+        """
+        :param timeout: 持续不可用超过该秒数后放弃，默认 Config.BATCH_OUTAGE_TIMEOUT
+        """
+        self.timeout = timeout if timeout is not None else Config.BATCH_OUTAGE_TIMEOUT
+        self.started = None
+        self.resume_at = 0.0
+
+    def hit(self, error):
+        """
+        记录一次因熔断失败的课次
+        :return: 是否仍在等待期限内（False 表示应放弃）
+        """
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        self.resume_at = max(self.resume_at, now + error.retry_after)
+        return now - self.started < self.timeout
+
+    def clear(self):
+        """有课次成功生成，服务已恢复"""
+        self.started = None
+
+    def waiting(self):
+        """是否处于暂停提交的冷却期"""
+        return time.monotonic() < self.resume_at
+
+
+class BatchGenerator:
+    """批量生成引擎：同时保持多节课在生成中，生成完的课立即交给文档渲染"""
+
+    def __init__(self, ai_generator, doc_builder, output_dir=None, fields=None, lesson_concurrency=None,
+                 use_cache=True, refresh_cache=False, render_workers=None, render_queue_size=None):
+        """
+        初始化批量生成引擎
+        :param ai_generator: AI生成器实例
+        :param doc_builder: 文档组装器实例
+        :param output_dir: 教案输出目录，默认 Config.OUTPUT_DIR
+        :param fields: 需要生成的字段列表，默认为模板中有占位符的教案字段（doc_builder 不支持时为全部教案字段）
+        :param lesson_concurrency: 同时生成的课次数，默认 Config.BATCH_LESSON_CONCURRENCY
+        :param use_cache: 是否读写响应缓存
+        :param refresh_cache: 丢弃已有缓存并重新生成
+        :param render_workers: 渲染进程数，默认 Config.RENDER_WORKERS（1 为单个渲染线程，0 为CPU核心数）
+        :param render_queue_size: 已生成、等待渲染的课次上限，默认 Config.RENDER_QUEUE_SIZE（0 为渲染进程数的两倍）
+        """
+        self.ai_generator = ai_generator
+        self.doc_builder = doc_builder
+        self.output_dir = output_dir or Config.OUTPUT_DIR
+        # 模板中没有占位符的字段生成了也用不上，直接跳过
+        self.skipped_fields = []
+        if fields is None and hasattr(doc_builder, "template_fields"):
+            fields, self.skipped_fields = doc_builder.template_fields()
+        self.fields = list(LESSON_FIELDS if fields is None else fields)
+        self.lesson_concurrency = max(1, lesson_concurrency or Config.BATCH_LESSON_CONCURRENCY)
+        self.use_cache = use_cache
+        self.refresh_cache = refresh_cache
+        workers = Config.RENDER_WORKERS if render_workers is None else render_workers
+        self.render_workers = max(1, workers if workers > 0 else (os.cpu_count() or 1))
+        queue_size = Config.RENDER_QUEUE_SIZE if render_queue_size is None else render_queue_size
+        self.render_queue_size = max(1, queue_size if queue_size > 0 else 2 * self.render_workers)
+
+    @staticmethod
+    def _field_progress(lesson_data, on_field_progress):
+        """给字段进度事件补充课次名称；未提供回调时不使用流式生成"""
+        if on_field_progress is None:
+            return None
+        label = lesson_label(lesson_data)
+        return lambda event: on_field_progress(dict(event, lesson=label))
+
+    def _render_lesson(self, lesson_data, ai_content):
+        """渲染单节课的教案文档（在渲染线程中执行）"""
+        output_filename = lesson_filename(lesson_data)
+        output_path = os.path.join(self.output_dir, output_filename)
+        self.doc_builder.build_lesson_plan(lesson_data, ai_content, output_path)
+        return output_filename
+
+    def _use_process_pool(self):
+        # 渲染进程按模板路径重新加载模板，只支持 DocumentBuilder
+        return self.render_workers > 1 and hasattr(self.doc_builder, "template_path")
+
+    def _render_pool(self):
+        """
+        创建渲染执行器：单个渲染线程，或 render_workers 个渲染进程（每个进程加载一次模板）
+        进程用 spawn 方式启动，不复制事件循环和连接池的状态
+        """
+        if not self._use_process_pool():
+            return ThreadPoolExecutor(max_workers=1, thread_name_prefix="lesson-render")
+        from document_builder import init_render_worker
+        logger.info(f"使用 {self.render_workers} 个渲染进程，等待渲染的课次上限 {self.render_queue_size}")
+        return ProcessPoolExecutor(max_workers=self.render_workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_render_worker,
+                                   initargs=(self.doc_builder.template_path, self.doc_builder.fast_write,
+                                             logging.getLogger().getEffectiveLevel()))
+
+    def _submit_render(self, render_pool, lesson_data, ai_content):
+        """提交渲染任务，结果为教案文件名"""
+        if not self._use_process_pool():
+            return render_pool.submit(self._render_lesson, lesson_data, ai_content)
+        from document_builder import render_in_worker
+        output_path = os.path.join(self.output_dir, lesson_filename(lesson_data))
+        return render_pool.submit(render_in_worker, lesson_data, ai_content, output_path)
+
+    def _counters(self):
+        """AI生成器的累计统计：模型加载耗时、prefix 模式节省的提示词评估token数、去重省去的请求数"""
+        prompt_stats = getattr(self.ai_generator, "prompt_eval_stats", {})
+        dedup_stats = getattr(self.ai_generator, "dedup_stats", {})
+        return {
+            "model_load_seconds": getattr(self.ai_generator, "load_seconds_total", 0.0),
+            "prompt_tokens_saved": prompt_stats.get("saved_tokens", 0),
+            "requests_deduplicated": dedup_stats.get("deduplicated", 0)
+        }
+
+    def _plan(self, schedule_data, syllabus_data):
+        """
+        批量开始前找出各课次之间完全相同的请求，每个只生成一次
+        :return: {"requests": 请求总数, "unique": 去重后的请求数}，AI生成器不支持时为None
+        """
+        if not hasattr(self.ai_generator, "plan_batch") or not self.fields:
+            return None
+        try:
+            return self.ai_generator.plan_batch(self.fields, schedule_data, syllabus_data)
+        except Exception as e:
+            # 计划失败不影响生成，只是不做批量去重
+            logger.warning(f"批量计划失败，不进行请求去重: {e}")
+            return None
+
+    async def _warm_up(self):
+        """
+        批量计划之后预热模型：计划已按全部课次中最长的提示词和当前生成模式的输出预留提升了 num_ctx 档位，
+        模型按生成时使用的档位加载，第一节课不会因 num_ctx 变化而重新加载
+        """
+        if getattr(self.ai_generator, "warmup", False):
+            await self.ai_generator.awarm_up()
+
+    def _clear_plan(self):
+        if hasattr(self.ai_generator, "clear_plan"):
+            self.ai_generator.clear_plan()
+
+    def _finish(self, result, start, counters_before):
+        """补充耗时和吞吐量统计；批量期间的模型加载耗时单独列出；统计跳过的字段；释放批量去重计划"""
+        self._clear_plan()
+        elapsed = time.perf_counter() - start
+        result["elapsed"] = elapsed
+        result["lessons_per_minute"] = len(result["completed"]) * 60 / elapsed if elapsed > 0 else 0.0
+        for name, value in self._counters().items():
+            result[name] = value - counters_before[name]
+        # 模板未使用的字段，每节课少生成的字段数
+        lessons = len(result["completed"]) + len(result["failed"])
+        result["field_generations_skipped"] = len(self.skipped_fields) * lessons
+        if self.skipped_fields:
+            logger.info(f"模板中没有占位符，跳过字段 {self.skipped_fields}，"
+                        f"共少生成 {result['field_generations_skipped']} 个字段")
+        if result.get("plan"):
+            logger.info(f"请求去重: 计划 {result['plan']['requests']} 个请求，"
+                        f"复用相同请求的结果 {result['requests_deduplicated']} 次")
+        logger.info(f"批量生成结束: 成功 {len(result['completed'])}/{result['total']}，"
+                    f"耗时 {elapsed:.1f}s（其中模型加载 {result['model_load_seconds']:.1f}s），"
+                    f"{result['lessons_per_minute']:.2f} 课/分钟")
+        return result
+
+    def run(self, schedule_data, syllabus_data=None, on_event=None, should_stop=None, should_pause=None,
+            on_field_progress=None):
+        """
+        流水线批量生成教案（命令行入口），在新的事件循环中运行 arun
+        参数与返回值同 arun，回调只能是普通函数，在调用 run 的线程中触发
+        """
+        return asyncio.run(self.arun(schedule_data, syllabus_data, on_event=on_event, should_stop=should_stop,
+                                     should_pause=should_pause, on_field_progress=on_field_progress))
+
+    async def arun(self, schedule_data, syllabus_data=None, on_event=None, should_stop=None, should_pause=None,
+                   on_field_progress=None):
+        """
+        流水线批量生成教案：AI请求走异步客户端，同时保持多节课在生成中，
+        生成完的课立即交给渲染线程或进程池，不阻塞事件循环
+        :param schedule_data: 教学进度表数据
+        :param syllabus_data: 教学大纲数据（可选）
+        :param on_event: 进度回调，参数为事件字典，可以是普通函数或协程函数；
+                         Ollama熔断时触发 backend_unavailable 事件，课次退回队列，冷却结束后重新生成
+        :param should_stop: 返回True时停止提交新的课次
+        :param should_pause: 返回True时暂停提交新的课次，已在途的课次继续完成
+        :param on_field_progress: 字段级流式进度回调，可以是普通函数或协程函数；提供时以流式方式生成
+        :return: 结果字典，包含成功文件、失败课次和吞吐量
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        loop = asyncio.get_running_loop()
+        total = len(schedule_data)
+        result = {"completed": [], "failed": [], "total": total, "stopped": False,
+                  "fields": list(self.fields), "skipped_fields": list(self.skipped_fields)}
+        start = time.perf_counter()
+        counters_before = self._counters()
+        result["plan"] = await loop.run_in_executor(None, self._plan, schedule_data, syllabus_data)
+
+        async def emit(event_type, lesson_data, **extra):
+            if on_event:
+                event = {
+                    "type": event_type,
+                    "lesson": lesson_label(lesson_data),
+                    "done": len(result["completed"]) + len(result["failed"]),
+                    "total": total
+                }
+                event.update(extra)
+                outcome = on_event(event)
+                if inspect.isawaitable(outcome):
+                    await outcome
+
+        pending = deque(schedule_data)
+        outage = BackendOutage()
+
+        async def generate(lesson_data):
+            """生成一节课的AI内容，失败或退回队列时返回None"""
+            try:
+                ai_content = {}
+                if self.fields:
+                    ai_content = await self.ai_generator.agenerate_lesson(
+                        self.fields, use_cache=self.use_cache, refresh_cache=self.refresh_cache, raise_on_error=True,
+                        on_progress=self._field_progress(lesson_data, on_field_progress),
+                        lesson_data=lesson_data, syllabus_data=syllabus_data
+                    )
+            except OllamaUnavailableError as e:
+                if outage.hit(e):
+                    # 课次退回队列头部，冷却结束后重新生成
+                    pending.appendleft(lesson_data)
+                    logger.warning(f"{lesson_label(lesson_data)}: {e}，批量生成暂停")
+                    await emit("backend_unavailable", lesson_data, error=str(e), retry_after=e.retry_after)
+                    return
+                logger.error(f"Ollama持续不可用超过{outage.timeout:.0f}秒，放弃{lesson_label(lesson_data)}")
+                result["failed"].append({"lesson": lesson_label(lesson_data), "error": str(e)})
+                await emit("lesson_failed", lesson_data, error=str(e))
+                return
+            except Exception as e:
+                logger.error(f"生成{lesson_label(lesson_data)}内容失败: {e}")
+                result["failed"].append({"lesson": lesson_label(lesson_data), "error": str(e)})
+                await emit("lesson_failed", lesson_data, error=str(e))
+                return
+            outage.clear()
+            await emit("lesson_generated", lesson_data)
+            return ai_content
+
+        async def render(lesson_data, ai_content, render_pool):
+            try:
+                filename = await asyncio.wrap_future(self._submit_render(render_pool, lesson_data, ai_content))
+            except Exception as e:
+                logger.error(f"渲染{lesson_label(lesson_data)}教案失败: {e}")
+                result["failed"].append({"lesson": lesson_label(lesson_data), "error": str(e)})
+                await emit("lesson_failed", lesson_data, error=str(e))
+                return
+            result["completed"].append(filename)
+            await emit("lesson_completed", lesson_data, filename=filename)
+
+        generating = {}
+        rendering = set()
+        # 本次批量使用当前事件循环共享的 httpx 客户端，同一事件循环中没有其他批量在进行时结束后关闭
+        async with async_client_session():
+            # 预热耗时单独记录，不计入生成耗时
+            warm_start = time.perf_counter()
+            await self._warm_up()
+            result["warmup_seconds"] = time.perf_counter() - warm_start
+            start += result["warmup_seconds"]
+
+            # 渲染单独使用一个线程或进程池，生成持续为后续课次请求AI内容；
+            # 生成和渲染分开计数：渲染不占用生成的并发名额，等待渲染的课次达到上限时暂停提交，内存占用不随课次数增长
+            with self._render_pool() as render_pool:
+                while True:
+                    while (pending and len(generating) < self.lesson_concurrency
+                           and len(rendering) < self.render_queue_size):
+                        if should_stop and should_stop():
+                            result["stopped"] = True
+                            pending.clear()
+                            break
+                        if (should_pause and should_pause()) or outage.waiting():
+                            break
+                        lesson_data = pending.popleft()
+                        generating[asyncio.create_task(generate(lesson_data))] = lesson_data
+                        await emit("lesson_started", lesson_data)
+
+                    if not generating and not rendering:
+                        if not pending:
+                            break
+                        # 处于暂停状态（用户暂停，或Ollama熔断冷却中），等待恢复
+                        await asyncio.sleep(0.5)
+                        continue
+
+                    # 等待任意一节课生成或渲染完成，超时后重新检查暂停和停止状态
+                    done, _ = await asyncio.wait(set(generating) | rendering, timeout=0.5,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task in generating:
+                            lesson_data = generating.pop(task)
+                            ai_content = task.result()
+                            if ai_content is not None:
+                                rendering.add(asyncio.create_task(render(lesson_data, ai_content, render_pool)))
+                        else:
+                            rendering.discard(task)
+
+        return self._finish(result, start, counters_before)
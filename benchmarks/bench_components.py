@@ -0,0 +1,230 @@
+"""
+组件微基准：不经过AI，单独测量数据解析和文档渲染的耗时
+
+对每个规模的测试数据（见 generate_fixtures.py）分别测量
+DataParser.parse_schedule、parse_syllabus、validate_excel_structure，
+以及 DocumentBuilder.build_lesson_plan 渲染一节课教案的耗时（AI内容为固定的假数据），
+并对比原来逐个占位符扫描的替换方式和单次扫描替换的耗时。
+每项重复多次，报告最小值和中位数，结果写入JSON文件以便比较不同版本。
+
+用法：
+    python benchmarks/bench_components.py
+    python benchmarks/bench_components.py --sizes small,medium,large --repeat 5 --lessons 20
+    python benchmarks/bench_components.py --fixtures benchmarks/fixtures --baseline benchmarks/results/上一次的结果.json
+"""
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import contextlib
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from bench_utils import percentile, peak_rss_mb, write_report, load_report
+from generate_fixtures import SIZES, generate, _sentence
+
+
+def measure(func, repeat):
+    """
+    重复调用 func 并计时
+    :return: ({"min": 秒, "median": 秒, "runs": 次数}, 最后一次的返回值)
+    """
+    timings, value = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = func()
+        timings.append(time.perf_counter() - start)
+    return {"min": round(min(timings), 4), "median": round(percentile(timings, 50), 4), "runs": repeat}, value
+
+
+def legacy_replace(doc, replacements):
+    """原来的替换方式（逐个占位符扫描正文段落和顶层表格，重设整段文本），用于对比"""
+    for p in doc.paragraphs:
+        for key, value in replacements.items():
+            if key in p.text:
+                p.text = p.text.replace(key, value)
+
+    for table in doc.tables:
+        for row in table.rows:
+            for cell in row.cells:
+                for p in cell.paragraphs:
+                    for key, value in replacements.items():
+                        if key in p.text:
+                            p.text = p.text.replace(key, value)
+
+
+def bench_substitution(template, values, repeat):
+    """
+    对比原来的替换方式和单次扫描替换的耗时（只计替换本身，不含复制文档）
+    :param template: CompiledTemplate
+    :param values: 占位符名到替换文本的字典
+    :return: 两种方式的计时结果
+    """
+    from document_builder import substitute_placeholders
+    replacements = {f"{{{{{name}}}}}": value for name, value in values.items()}
+    timings = {"legacy": [], "single_pass": []}
+    for _ in range(repeat):
+        doc, _ = template.clone()
+        start = time.perf_counter()
+        legacy_replace(doc, replacements)
+        timings["legacy"].append(time.perf_counter() - start)
+
+        _, paragraphs = template.clone()
+        start = time.perf_counter()
+        substitute_placeholders(paragraphs, values)
+        timings["single_pass"].append(time.perf_counter() - start)
+    return {name: {"min_ms": round(min(samples) * 1000, 3), "median_ms": round(percentile(samples, 50) * 1000, 3)}
+            for name, samples in timings.items()}
+
+
+def fake_content(fields, seed=0):
+    """每个字段约300字的固定假内容"""
+    rng = random.Random(seed)
+    return {field: _sentence(rng, 300) for field in fields}
+
+
+def bench_fixtures(paths, repeat, lessons):
+    """
+    测量一组测试数据上的各项耗时
+    :param paths: generate() 返回的路径字典
+    :param repeat: 每项的重复次数
+    :param lessons: 渲染的课次数
+    :return: 各项的计时结果
+    """
+    from data_parser import DataParser
+    from document_builder import DocumentBuilder, CompiledTemplate
+    from ai_generator import LESSON_FIELDS
+
+    results = {}
+    results["parse_schedule"], schedule = measure(lambda: DataParser.parse_schedule(paths["schedule"]), repeat)
+    results["parse_syllabus"], _ = measure(lambda: DataParser.parse_syllabus(paths["syllabus"]), repeat)
+    results["validate_excel_structure"], _ = measure(
+        lambda: DataParser.validate_excel_structure(paths["schedule"]), repeat)
+    results["parse_schedule"]["rows"] = len(schedule)
+
+    builder = DocumentBuilder(paths["template"])
+    content = fake_content(LESSON_FIELDS)
+    sample = schedule[:lessons]
+    with tempfile.TemporaryDirectory(prefix="bench-render-") as out_dir:
+        def render():
+            for i, lesson in enumerate(sample):
+                builder.build_lesson_plan(lesson, content, os.path.join(out_dir, f"{i}.docx"))
+
+        timing, _ = measure(render, repeat)
+        output_size = os.path.getsize(os.path.join(out_dir, "0.docx")) if sample else 0
+    per_lesson = len(sample) or 1
+    results["build_lesson_plan"] = {
+        "lessons": len(sample),
+        "min_ms_per_lesson": round(timing["min"] * 1000 / per_lesson, 2),
+        "median_ms_per_lesson": round(timing["median"] * 1000 / per_lesson, 2),
+        "output_kb": round(output_size / 1024, 1),
+        "runs": repeat
+    }
+    if sample:
+        values = dict(content, week=str(sample[0]["week"]), lesson=str(sample[0]["lesson"]),
+                      course_name=sample[0]["课程名称"], chapter_content=sample[0]["章节内容"],
+                      class_hours=str(sample[0]["课时"]))
+        results["substitution"] = bench_substitution(CompiledTemplate.from_file(paths["template"]), values, repeat)
+    results["template_kb"] = round(os.path.getsize(paths["template"]) / 1024, 1)
+    return results
+
+
+def run_benchmarks(args):
+    """依次测量每个规模，--fixtures 指定时只测量该目录中的文件"""
+    if args.fixtures:
+        targets = [("custom", {name: os.path.join(args.fixtures, filename) for name, filename in
+                               [("schedule", "schedule.xlsx"), ("syllabus", "syllabus.docx"),
+                                ("template", "template.docx")]})]
+    else:
+        targets = [(size, None) for size in args.sizes]
+
+    report = {}
+    with tempfile.TemporaryDirectory(prefix="bench-fixtures-") as workdir:
+        for size, paths in targets:
+            if paths is None:
+                print(f"生成 {size} 测试数据 ...", end="", flush=True)
+                start = time.perf_counter()
+                paths = generate(os.path.join(workdir, size), seed=args.seed, **SIZES[size])
+                print(f" {time.perf_counter() - start:.1f}s")
+            # 解析和渲染过程中的打印和日志不计入结果
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results = bench_fixtures(paths, args.repeat, args.lessons)
+            report[size] = results
+            render = results["build_lesson_plan"]
+            print(f"  {size}: 进度表 {results['parse_schedule']['median']}s（{results['parse_schedule']['rows']}行），"
+                  f"大纲 {results['parse_syllabus']['median']}s，校验 {results['validate_excel_structure']['median']}s，"
+                  f"渲染 {render['median_ms_per_lesson']}ms/课（模板 {results['template_kb']}KB）")
+            if "substitution" in results:
+                substitution = results["substitution"]
+                print(f"  {size}: 占位符替换 原方式 {substitution['legacy']['median_ms']}ms，"
+                      f"单次扫描 {substitution['single_pass']['median_ms']}ms")
+    return report
+
+
+def compare(results, baseline_path):
+    """与之前的结果文件逐项比较中位数"""
+    baseline = load_report(baseline_path)["sizes"]
+    print(f"\n与 {baseline_path} 比较（中位数）：")
+    for size, items in results.items():
+        before = baseline.get(size)
+        if before is None:
+            continue
+        for name in ("parse_schedule", "parse_syllabus", "validate_excel_structure"):
+            old, new = before[name]["median"], items[name]["median"]
+            change = (new / old - 1) if old else 0
+            print(f"  {size} {name}: {old} → {new}s ({change:+.1%})")
+        old = before["build_lesson_plan"]["median_ms_per_lesson"]
+        new = items["build_lesson_plan"]["median_ms_per_lesson"]
+        change = (new / old - 1) if old else 0
+        print(f"  {size} build_lesson_plan: {old} → {new}ms/课 ({change:+.1%})")
+        if "substitution" in before and "substitution" in items:
+            old = before["substitution"]["single_pass"]["median_ms"]
+            new = items["substitution"]["single_pass"]["median_ms"]
+            change = (new / old - 1) if old else 0
+            print(f"  {size} substitution: {old} → {new}ms ({change:+.1%})")
+
+
+def _str_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据解析和文档渲染的组件微基准')
+    parser.add_argument('--sizes', type=_str_list, default=["small", "medium"],
+                        help=f'测试数据规模，逗号分隔，可选 {",".join(SIZES)}')
+    parser.add_argument('--fixtures', help='使用已生成的测试数据目录（含 schedule.xlsx、syllabus.docx、template.docx）')
+    parser.add_argument('--repeat', type=int, default=3, help='每项的重复次数')
+    parser.add_argument('--lessons', type=int, default=10, help='每次渲染的课次数')
+    parser.add_argument('--seed', type=int, default=0, help='测试数据的随机种子')
+    parser.add_argument('-o', '--output', help='结果文件路径，默认 benchmarks/results/components-时间.json')
+    parser.add_argument('--baseline', help='与之前的结果文件比较')
+    args = parser.parse_args()
+
+    unknown = [s for s in args.sizes if s not in SIZES]
+    if unknown and not args.fixtures:
+        parser.error(f"未知的规模: {unknown}")
+
+    # 计时期间只保留警告和错误日志
+    from config import Config
+    Config.LOG_LEVEL = "WARNING"
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run_benchmarks(args)
+    write_report("components", {
+        "repeat": args.repeat,
+        "lessons": args.lessons,
+        "presets": {size: SIZES[size] for size in results if size in SIZES},
+        "sizes": results,
+        "peak_rss_mb": peak_rss_mb()
+    }, args.output)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+端到端吞吐量基准：教学进度表 → AI生成 → Word教案
+
+每个场景在独立的子进程中运行完整流水线（解析进度表和大纲、批量生成、渲染文档），
+AI请求发给同一进程内启动的模拟Ollama服务（fake_ollama.py），结果写入JSON文件以便比较不同版本。
+
+用法：
+    python benchmarks/bench_pipeline.py
+    python benchmarks/bench_pipeline.py --lessons 8,32 --concurrency 1,2,4 --profiles fast,typical
+    python benchmarks/bench_pipeline.py --baseline benchmarks/results/上一次的结果.json
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:
+    # Windows 没有 resource 模块，不统计峰值内存
+    resource = None
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from fake_ollama import FakeOllama
+from bench_utils import percentile, peak_rss_mb, write_report, load_report
+from generate_fixtures import write_schedule
+
+# 模拟后端的延迟配置，参数同 FakeOllama
+LATENCY_PROFILES = {
+    # 几乎没有延迟，测量流水线本身（解析、调度、渲染）的开销
+    "fast": {"latency": 0.01, "tokens_per_second": 0, "prompt_tokens_per_second": 0, "output_tokens": 120},
+    # 接近单卡上的小模型：首个token约0.2秒，400 tokens/s
+    "typical": {"latency": 0.2, "latency_dist": "lognormal", "jitter": 0.3, "tokens_per_second": 400,
+                "output_tokens": 120},
+    # 慢且不稳定的后端：长尾延迟加2%的错误率
+    "slow": {"latency": 0.5, "latency_dist": "lognormal", "jitter": 0.6, "tokens_per_second": 100,
+             "output_tokens": 120, "error_rate": 0.02}
+}
+
+
+def _cpu_seconds():
+    """本进程和已结束的子进程（渲染进程）的CPU时间"""
+    if resource is None:
+        return time.process_time()
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def run_scenario(scenario):
+    """
+    在当前（子）进程中运行一个场景
+    :param scenario: 场景参数，包含 url、lessons、concurrency、render_workers、mode、field_concurrency、
+                     max_inflight、template
+    :return: 场景结果字典
+    """
+    import logging
+    import contextlib
+    from config import Config
+
+    # 配置必须在创建 AIGenerator 之前设置
+    Config.OLLAMA_HOST = scenario["url"]
+    Config.OLLAMA_MAX_INFLIGHT = scenario["max_inflight"]
+    Config.OLLAMA_FIELD_CONCURRENCY = scenario["field_concurrency"]
+    Config.GENERATION_MODE = scenario["mode"]
+    Config.CACHE_ENABLED = False
+    Config.LOG_LEVEL = "WARNING"
+
+    from data_parser import DataParser
+    from ai_generator import AIGenerator
+    from document_builder import DocumentBuilder
+    from batch_generator import BatchGenerator
+
+    template = scenario["template"]
+    syllabus = os.path.join(PROJECT_ROOT, "test_data", "syllabus.docx")
+    latencies = {}
+
+    with tempfile.TemporaryDirectory(prefix="bench-pipeline-") as workdir, \
+            open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        logging.getLogger().setLevel(logging.WARNING)
+        schedule_path = os.path.join(workdir, "schedule.xlsx")
+        write_schedule(schedule_path, scenario["lessons"])
+
+        # 预热在批量计划之后进行，耗时从总耗时中扣除，模型加载不计入吞吐量
+        ai_generator = AIGenerator()
+
+        # 记录每个实际发出的请求的耗时（含排队），按字段汇总
+        def timed(request):
+            async def wrapper(data, use_cache, refresh_cache, on_progress, prompt_type, path):
+                start = time.perf_counter()
+                try:
+                    return await request(data, use_cache, refresh_cache, on_progress, prompt_type, path)
+                finally:
+                    latencies.setdefault(prompt_type, []).append(time.perf_counter() - start)
+            return wrapper
+
+        ai_generator._arequest = timed(ai_generator._arequest)
+
+        cpu_start = _cpu_seconds()
+        wall_start = time.perf_counter()
+        schedule_data = DataParser.parse_schedule(schedule_path)
+        syllabus_data = DataParser.parse_syllabus(syllabus)
+        parse_seconds = time.perf_counter() - wall_start
+
+        batch = BatchGenerator(ai_generator, DocumentBuilder(template), output_dir=os.path.join(workdir, "out"),
+                               lesson_concurrency=scenario["concurrency"], use_cache=False,
+                               render_workers=scenario["render_workers"])
+        result = batch.run(schedule_data, syllabus_data)
+        wall = time.perf_counter() - wall_start - result["warmup_seconds"]
+        cpu = _cpu_seconds() - cpu_start
+
+    fields = {}
+    for field, values in sorted(latencies.items()):
+        fields[field] = {
+            "requests": len(values),
+            "p50": round(percentile(values, 50), 4),
+            "p95": round(percentile(values, 95), 4),
+            "p99": round(percentile(values, 99), 4)
+        }
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "completed": len(result["completed"]),
+        "failed": len(result["failed"]),
+        "wall_seconds": round(wall, 3),
+        "parse_seconds": round(parse_seconds, 3),
+        "lessons_per_minute": round(len(result["completed"]) * 60 / wall, 2) if wall > 0 else 0.0,
+        "cpu_seconds": round(cpu, 3),
+        "cpu_per_lesson_ms": round(cpu * 1000 / max(1, len(result["completed"])), 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "requests": len(all_latencies),
+        "latency": {
+            "p50": round(percentile(all_latencies, 50), 4) if all_latencies else None,
+            "p95": round(percentile(all_latencies, 95), 4) if all_latencies else None,
+            "p99": round(percentile(all_latencies, 99), 4) if all_latencies else None
+        },
+        "field_latency": fields
+    }
+
+
+def scenario_key(scenario):
+    """用于在两次结果之间对应同一个场景"""
+    return (scenario["profile"], scenario["mode"], scenario["lessons"], scenario["concurrency"],
+            scenario.get("render_workers", 1))
+
+
+def run_benchmarks(args):
+    """依次运行全部场景组合"""
+    scenarios = []
+    for profile in args.profiles:
+        for mode in args.modes:
+            for lessons in args.lessons:
+                for concurrency in args.concurrency:
+                    for render_workers in args.render_workers:
+                        scenarios.append({"profile": profile, "mode": mode, "lessons": lessons,
+                                          "concurrency": concurrency, "render_workers": render_workers,
+                                          "field_concurrency": args.field_concurrency,
+                                          "max_inflight": args.ollama_parallel, "template": args.template})
+
+    # 子进程用 spawn 启动，每个场景的CPU时间和峰值内存互不影响
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for i, scenario in enumerate(scenarios, 1):
+        fake = FakeOllama(max_concurrency=args.ollama_parallel, seed=args.seed, **LATENCY_PROFILES[scenario["profile"]])
+        scenario["url"] = fake.start()
+        label = (f"[{i}/{len(scenarios)}] {scenario['profile']} {scenario['mode']} "
+                 f"{scenario['lessons']}课 并发{scenario['concurrency']} 渲染进程{scenario['render_workers']}")
+        print(f"{label} ...", end="", flush=True)
+        try:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                outcome = executor.submit(run_scenario, scenario).result()
+        finally:
+            stats = fake.stats()
+            fake.stop()
+        outcome["backend"] = {k: stats[k] for k in ("requests", "errors", "max_active", "loads")}
+        del scenario["url"]
+        results.append(dict(scenario, result=outcome))
+        print(f" {outcome['lessons_per_minute']:.1f} 课/分钟，p95 {outcome['latency']['p95']}s，"
+              f"CPU {outcome['cpu_seconds']:.2f}s，峰值内存 {outcome['peak_rss_mb']}MB")
+    return results
+
+
+def compare(results, baseline_path):
+    """与之前的结果文件逐场景比较吞吐量和p95延迟"""
+    baseline = {scenario_key(item): item["result"] for item in load_report(baseline_path)["scenarios"]}
+    print(f"\n与 {baseline_path} 比较：")
+    for item in results:
+        before = baseline.get(scenario_key(item))
+        if before is None:
+            continue
+        after = item["result"]
+        change = (after["lessons_per_minute"] / before["lessons_per_minute"] - 1) if before["lessons_per_minute"] else 0
+        print(f"  {item['profile']} {item['mode']} {item['lessons']}课 并发{item['concurrency']} "
+              f"渲染进程{item['render_workers']}: "
+              f"{before['lessons_per_minute']:.1f} → {after['lessons_per_minute']:.1f} 课/分钟 ({change:+.1%})，"
+              f"p95 {before['latency']['p95']} → {after['latency']['p95']}s，"
+              f"CPU {before['cpu_seconds']:.2f} → {after['cpu_seconds']:.2f}s")
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _str_list(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='教案生成流水线端到端吞吐量基准')
+    parser.add_argument('--lessons', type=_int_list, default=[8, 32], help='课次数，逗号分隔')
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 4], help='同时生成的课次数，逗号分隔')
+    parser.add_argument('--profiles', type=_str_list, default=["fast", "typical"],
+                        help=f'模拟后端的延迟配置，逗号分隔，可选 {",".join(LATENCY_PROFILES)}')
+    parser.add_argument('--modes', type=_str_list, default=["per_field"],
+                        help='生成模式，逗号分隔：per_field、structured、prefix')
+    parser.add_argument('--render-workers', type=_int_list, default=[1], help='渲染进程数，逗号分隔（1为单个渲染线程）')
+    parser.add_argument('--template', default=os.path.join(PROJECT_ROOT, "test_data", "template.docx"),
+                        help='教案模板，可用 generate_fixtures.py 生成的大模板测试渲染')
+    parser.add_argument('--field-concurrency', type=int, default=4, help='单节课内并发的字段数')
+    parser.add_argument('--ollama-parallel', type=int, default=4, help='模拟后端的并行槽位数（同时也是在途请求上限）')
+    parser.add_argument('--seed', type=int, default=42, help='模拟后端的随机种子')
+    parser.add_argument('-o', '--output', help='结果文件路径，默认 benchmarks/results/pipeline-时间.json')
+    parser.add_argument('--baseline', help='与之前的结果文件比较')
+    args = parser.parse_args()
+
+    unknown = [p for p in args.profiles if p not in LATENCY_PROFILES]
+    if unknown:
+        parser.error(f"未知的延迟配置: {unknown}")
+
+    results = run_benchmarks(args)
+    write_report("pipeline", {
+        "profiles": {name: LATENCY_PROFILES[name] for name in args.profiles},
+        "scenarios": results
+    }, args.output)
+
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
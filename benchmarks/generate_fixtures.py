@@ -0,0 +1,206 @@
+"""
+生成任意规模的测试数据：教学进度表、教学大纲和教案模板
+
+create_test_excel.py 和 create_test_docs.py 只生成很小的示例文件，这里的生成器可以生成
+数千行、带多余列和多个工作表的进度表，数千段的大纲，以及带大表格、页眉页脚和图片的模板，
+用于测量解析和文档渲染本身的开销。
+
+用法：
+    python benchmarks/generate_fixtures.py --size large -o benchmarks/fixtures
+    python benchmarks/generate_fixtures.py --rows 5000 --extra-columns 30 --sheets 3 --paragraphs 8000
+"""
+import os
+import io
+import sys
+import zlib
+import struct
+import random
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from ai_generator import LESSON_FIELDS
+
+# 预设规模：进度表行数、多余列数、工作表数、大纲段落数、模板大表格行数、图片边长（像素）
+SIZES = {
+    "small": {"rows": 100, "extra_columns": 4, "sheets": 1, "paragraphs": 200, "table_rows": 20, "image_pixels": 64},
+    "medium": {"rows": 1000, "extra_columns": 12, "sheets": 2, "paragraphs": 2000, "table_rows": 200,
+               "image_pixels": 256},
+    "large": {"rows": 5000, "extra_columns": 30, "sheets": 3, "paragraphs": 8000, "table_rows": 1000,
+              "image_pixels": 512}
+}
+
+TOPICS = ["变量与数据类型", "条件语句与循环", "函数定义与调用", "参数与返回值", "类与对象", "继承与多态",
+          "文件读写", "异常处理", "模块导入与使用", "标准库介绍", "Socket编程基础", "HTTP请求处理",
+          "SQLite数据库", "MySQL数据库连接", "Flask框架基础", "路由与模板", "Pandas数据分析", "数据可视化"]
+PHRASES = ["理解基本概念并能够举例说明", "掌握常用语法和典型用法", "能够独立完成综合练习",
+           "结合企业真实案例分析问题", "培养规范编码和团队协作意识", "通过实验验证并总结规律",
+           "能够排查常见错误并给出解决方案", "了解相关技术的发展和应用场景"]
+
+
+def _sentence(rng, length):
+    """拼接指定长度左右的中文段落"""
+    parts, size = [], 0
+    while size < length:
+        part = f"{rng.choice(TOPICS)}：{rng.choice(PHRASES)}。"
+        parts.append(part)
+        size += len(part)
+    return "".join(parts)
+
+
+def write_schedule(path, rows, extra_columns=0, sheets=1, seed=0):
+    """
+    生成教学进度表：第一个工作表为课程安排（每周两次课），其余工作表为无关的数据
+    :param path: 输出的 .xlsx 路径
+    :param rows: 课次数
+    :param extra_columns: 除必需列以外附加的列数（班级、教学地点等，超出部分为备用列）
+    :param sheets: 工作表总数
+    :param seed: 随机种子
+    """
+    import pandas as pd
+    rng = random.Random(seed)
+    optional = ["班级", "教学地点", "教师", "备注"]
+    data = {
+        "周次": [i // 2 + 1 for i in range(rows)],
+        "课次": [i % 2 + 1 for i in range(rows)],
+        "课程名称": ["Python程序设计"] * rows,
+        "章节内容": [f"{TOPICS[i % len(TOPICS)]}（第{i + 1}讲）" for i in range(rows)],
+        "课时": [2] * rows
+    }
+    for i in range(extra_columns):
+        name = optional[i] if i < len(optional) else f"备用列{i - len(optional) + 1}"
+        data[name] = [_sentence(rng, 10)[:rng.randint(4, 20)] for _ in range(rows)]
+
+    with pd.ExcelWriter(path, engine="openpyxl") as writer:
+        pd.DataFrame(data).to_excel(writer, sheet_name="教学进度", index=False)
+        for sheet in range(1, sheets):
+            filler = {f"列{c + 1}": [rng.randint(0, 1000) for _ in range(rows)] for c in range(8)}
+            pd.DataFrame(filler).to_excel(writer, sheet_name=f"其他{sheet}", index=False)
+
+
+def write_syllabus(path, paragraphs, seed=0):
+    """
+    生成教学大纲：每20段一个章节标题，段落长度随机
+    :param path: 输出的 .docx 路径
+    :param paragraphs: 段落数（含标题）
+    :param seed: 随机种子
+    """
+    from docx import Document
+    rng = random.Random(seed)
+    doc = Document()
+    doc.add_heading("课程教学大纲", level=1)
+    for i in range(paragraphs - 1):
+        if i % 20 == 0:
+            doc.add_heading(f"第{i // 20 + 1}章 {TOPICS[(i // 20) % len(TOPICS)]}", level=2)
+        else:
+            doc.add_paragraph(_sentence(rng, rng.randint(40, 200)))
+    doc.save(path)
+
+
+def make_png(pixels, seed=0):
+    """生成边长为 pixels 的随机彩色PNG（几乎不可压缩），模拟模板中的校徽等图片"""
+    rng = random.Random(seed)
+    raw = b"".join(b"\x00" + rng.randbytes(pixels * 3) for _ in range(pixels))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack(">IIBBBBB", pixels, pixels, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+def write_template(path, table_rows=20, image_pixels=0, seed=0):
+    """
+    生成教案模板：页眉页脚、基本信息表、每个AI字段一行的内容表，拆分到多个 run 中的占位符，
+    一个 table_rows 行的大表格（评分细则），以及嵌套在单元格中的表格
+    :param path: 输出的 .docx 路径
+    :param table_rows: 大表格的行数
+    :param image_pixels: 页眉中图片的边长，0表示不加图片
+    :param seed: 随机种子
+    """
+    from docx import Document
+    from docx.shared import Inches
+    rng = random.Random(seed)
+    doc = Document()
+    section = doc.sections[0]
+    header = section.header.paragraphs[0]
+    if image_pixels:
+        header.add_run().add_picture(io.BytesIO(make_png(image_pixels, seed)), width=Inches(0.6))
+    header.add_run("{{course_name}} 教案")
+    section.footer.paragraphs[0].text = "第{{week}}周第{{lesson}}次课"
+
+    doc.add_heading("{{course_name}} 教案", level=1)
+    info = doc.add_table(rows=2, cols=4)
+    for i, (label, placeholder) in enumerate([("周次", "{{week}}"), ("课次", "{{lesson}}"),
+                                              ("章节内容", "{{chapter_content}}"), ("课时", "{{class_hours}}")]):
+        info.cell(0, i).text = label
+        info.cell(1, i).text = placeholder
+
+    content = doc.add_table(rows=len(LESSON_FIELDS), cols=2)
+    for i, field in enumerate(LESSON_FIELDS):
+        content.cell(i, 0).text = field
+        content.cell(i, 1).text = f"{{{{{field}}}}}"
+    # 嵌套表格：单元格中再放一个两行的表格
+    nested = content.cell(0, 0).add_table(rows=2, cols=2)
+    nested.cell(0, 0).text = "课程"
+    nested.cell(0, 1).text = "{{course_name}}"
+    nested.cell(1, 0).text = "章节"
+    nested.cell(1, 1).text = "{{chapter_content}}"
+
+    # Word 编辑过的模板中，一个占位符常被拆到多个格式不同的 run 中
+    split = doc.add_paragraph("授课周次：")
+    split.add_run("{{we")
+    split.add_run("ek}}").bold = True
+    split.add_run("，课时：{")
+    split.add_run("{class_hours}}")
+
+    doc.add_heading("评分细则", level=2)
+    rubric = doc.add_table(rows=table_rows, cols=5)
+    for row in rubric.rows:
+        for cell in row.cells:
+            cell.text = _sentence(rng, rng.randint(6, 30))
+    doc.add_paragraph("教师签名：__________    日期：__________")
+    doc.save(path)
+
+
+def generate(output_dir, rows, extra_columns, sheets, paragraphs, table_rows, image_pixels, seed=0):
+    """
+    在 output_dir 中生成 schedule.xlsx、syllabus.docx 和 template.docx
+    :return: {"schedule": 路径, "syllabus": 路径, "template": 路径}
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {name: os.path.join(output_dir, filename) for name, filename in
+             [("schedule", "schedule.xlsx"), ("syllabus", "syllabus.docx"), ("template", "template.docx")]}
+    write_schedule(paths["schedule"], rows, extra_columns, sheets, seed)
+    write_syllabus(paths["syllabus"], paragraphs, seed)
+    write_template(paths["template"], table_rows, image_pixels, seed)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成大规模测试数据（进度表、大纲、模板）')
+    parser.add_argument('--size', choices=SIZES, default='medium', help='预设规模，单项参数可覆盖')
+    parser.add_argument('--rows', type=int, help='进度表课次数')
+    parser.add_argument('--extra-columns', type=int, help='进度表附加的列数')
+    parser.add_argument('--sheets', type=int, help='进度表的工作表数')
+    parser.add_argument('--paragraphs', type=int, help='大纲段落数')
+    parser.add_argument('--table-rows', type=int, help='模板中大表格的行数')
+    parser.add_argument('--image-pixels', type=int, help='模板页眉图片的边长（像素），0表示不加图片')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('-o', '--output-dir', default=os.path.join(PROJECT_ROOT, 'benchmarks', 'fixtures'),
+                        help='输出目录')
+    args = parser.parse_args()
+
+    params = dict(SIZES[args.size])
+    for name in params:
+        value = getattr(args, name)
+        if value is not None:
+            params[name] = value
+    paths = generate(args.output_dir, seed=args.seed, **params)
+    for name, path in paths.items():
+        print(f"{name}: {path} ({os.path.getsize(path) / 1024:.0f}KB)")
+
+
+if __name__ == "__main__":
+    main()
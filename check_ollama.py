@@ -1,29 +1,31 @@
+import argparse
 import requests
 import json
+from config import Config
 
-OLLAMA_HOST = "http://localhost:11434"
-
-def check_ollama_api():
+def check_ollama_api(host):
     """
     一个独立的脚本，用于诊断本地Ollama服务的API是否健康。
+    :param host: Ollama服务地址
+    :return: 服务是否正常
     """
     print(f"--- Ollama 服务健康检查 ---")
-    print(f"目标地址: {OLLAMA_HOST}")
+    print(f"目标地址: {host}")
 
     try:
         # 1. 检查根路径，确认服务在运行
         print("\n[步骤 1/2] 检查基础连接...")
-        response = requests.get(OLLAMA_HOST, timeout=5)
+        response = requests.get(host, timeout=5)
         if response.status_code == 200 and "Ollama is running" in response.text:
             print("✅ 基础连接成功，Ollama 服务正在运行。")
         else:
             print(f"❌ 基础连接失败。状态码: {response.status_code}")
             print("请确认Ollama应用已在您的电脑上启动。")
-            return
+            return False
 
         # 2. 检查核心API，确认功能完整
         print("\n[步骤 2/2] 检查核心 API (/api/tags)...")
-        api_url = f"{OLLAMA_HOST}/api/tags"
+        api_url = f"{host}/api/tags"
         response = requests.get(api_url, timeout=10)
         
         if response.status_code == 404:
@@ -33,7 +35,7 @@ def check_ollama_api():
             print("这是导致主程序报错的根本原因。")
             print("\n--- 修复建议 ---")
             print("请完全卸载您当前的 Ollama，然后从官网 (https://ollama.com/) 下载并安装最新版本。")
-            return
+            return False
 
         response.raise_for_status() # 检查其他HTTP错误
         
@@ -47,6 +49,7 @@ def check_ollama_api():
                 print(f"  - {model['name']}")
         else:
             print("你尚未下载任何模型。请使用 'ollama pull <model_name>' 下载一个。")
+        return True
 
     except requests.exceptions.RequestException as e:
         print(f"❌ 连接到 Ollama 服务时发生网络错误。")
@@ -54,7 +57,14 @@ def check_ollama_api():
         print("\n--- 修复建议 ---")
         print("1. 确认 Ollama 应用正在您的电脑上运行。")
         print("2. 检查防火墙或杀毒软件是否阻止了网络连接。")
-        print("3. 确认 {OLLAMA_HOST} 地址是否正确。")
+        print(f"3. 确认 {host} 地址是否正确。")
+        print("4. 没有GPU或只需测试流程时，可以运行 python fake_ollama.py 启动模拟服务。")
+        return False
 
 if __name__ == "__main__":
-    check_ollama_api()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Ollama服务健康检查')
+    parser.add_argument('--host', help='Ollama服务地址，默认使用环境变量 OLLAMA_HOST 中的全部地址')
+    args = parser.parse_args()
+    hosts = [args.host.rstrip("/")] if args.host else Config.get_ollama_hosts()
+    results = [check_ollama_api(host) for host in hosts]
+    exit(0 if all(results) else 1)
\ No newline at end of file
@@ -7,7 +7,7 @@
 
 import os
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List
 
 # 配置类
 class Config:
@@ -15,9 +15,66 @@ class Config:
     
     # Ollama配置
     OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen3:1.7b")
+    # 可以用逗号分隔多个地址，请求按在途数最少的原则分配到各主机
     OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
-    OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "60"))
+    # 读取超时（等待模型生成完整回答），连接超时单独配置
+    OLLAMA_TIMEOUT = int(os.getenv("OLLAMA_TIMEOUT", "180"))
+    OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+    # 每个Ollama主机保持的长连接数上限
+    OLLAMA_POOL_MAXSIZE = int(os.getenv("OLLAMA_POOL_MAXSIZE", "8"))
+    # 超时、连接失败和5xx错误的重试次数，重试间隔按指数退避并加入随机抖动
     OLLAMA_MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", "3"))
+    OLLAMA_RETRY_BACKOFF = float(os.getenv("OLLAMA_RETRY_BACKOFF", "1"))
+    OLLAMA_RETRY_BACKOFF_MAX = float(os.getenv("OLLAMA_RETRY_BACKOFF_MAX", "30"))
+    # 熔断：连续失败达到阈值后暂停请求，冷却时间过后再放行一个探测请求
+    OLLAMA_BREAKER_THRESHOLD = int(os.getenv("OLLAMA_BREAKER_THRESHOLD", "5"))
+    OLLAMA_BREAKER_COOLDOWN = float(os.getenv("OLLAMA_BREAKER_COOLDOWN", "30"))
+    # 单个教案内同时向Ollama发起的字段请求数（需配合 OLLAMA_NUM_PARALLEL > 1）
+    OLLAMA_FIELD_CONCURRENCY = int(os.getenv("OLLAMA_FIELD_CONCURRENCY", "4"))
+    # 每个Ollama主机同时在途的请求数上限，一般等于该主机的并行槽位数
+    OLLAMA_MAX_INFLIGHT = int(os.getenv("OLLAMA_MAX_INFLIGHT", "4"))
+    
+    # 启动时预先把模型加载到显存，避免第一节课承担模型加载耗时
+    OLLAMA_WARMUP = os.getenv("OLLAMA_WARMUP", "true").lower() in ("1", "true", "yes")
+    # 每次请求携带的 keep_alive，批量生成期间模型保持加载（Ollama时长格式，如 30m；-1 表示一直保持）
+    OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+    # 按字段选择模型：格式为 字段=模型，多个用逗号分隔，如 "教学资源=qwen3:0.6b,作业布置=qwen3:0.6b"；
+    # 未列出的字段使用 OLLAMA_MODEL
+    OLLAMA_FIELD_MODELS = os.getenv("OLLAMA_FIELD_MODELS", "")
+    # 是否让推理模型（如 qwen3）输出思考过程；关闭后字段直接输出正文，思考内容不计入输出token
+    OLLAMA_THINK = os.getenv("OLLAMA_THINK", "false").lower() in ("1", "true", "yes")
+    
+    # 生成模式：per_field（每个字段单独请求）、structured（每节课一次请求生成全部字段）
+    # 或 prefix（同一节课的字段依次请求，共享课次前缀以复用Ollama已评估的上下文）
+    GENERATION_MODE = os.getenv("GENERATION_MODE", "per_field")
+    GENERATION_MODES = ("per_field", "structured", "prefix")
+    
+    # 提示词token预算：每个请求按提示词长度从这些档位中选择最小够用的 num_ctx
+    OLLAMA_NUM_CTX_BUCKETS = os.getenv("OLLAMA_NUM_CTX_BUCKETS", "2048,4096,8192,16384")
+    # 单个请求提示词的token上限（大纲节选在此范围内裁剪），以及章节内容的token上限
+    PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "3000"))
+    PROMPT_CHAPTER_TOKENS = int(os.getenv("PROMPT_CHAPTER_TOKENS", "300"))
+    
+    # 教学大纲检索：每节课附加到提示词中的大纲节选token预算（0表示不附加），以及索引片段的目标字数
+    SYLLABUS_CONTEXT_TOKENS = int(os.getenv("SYLLABUS_CONTEXT_TOKENS", "600"))
+    SYLLABUS_CHUNK_CHARS = int(os.getenv("SYLLABUS_CHUNK_CHARS", "300"))
+    
+    # 流式生成时通过WebSocket推送字段进度的最小间隔（秒）
+    STREAM_PROGRESS_INTERVAL = float(os.getenv("STREAM_PROGRESS_INTERVAL", "0.5"))
+    
+    # 批量生成配置
+    BATCH_LESSON_CONCURRENCY = int(os.getenv("BATCH_LESSON_CONCURRENCY", "2"))
+    # Ollama持续不可用超过该时长（秒）后放弃剩余课次
+    BATCH_OUTAGE_TIMEOUT = float(os.getenv("BATCH_OUTAGE_TIMEOUT", "600"))
+    
+    # 文档渲染配置：进程内缓存的已编译模板数量
+    TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "8"))
+    # 渲染教案的进程数：1 为单个渲染线程，大于1时使用进程池，0 表示使用全部CPU核心
+    RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "1"))
+    # 已生成、等待渲染的课次上限，达到后暂停提交新的课次；0 表示渲染进程数的两倍
+    RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "0"))
+    # 直接在zip层面写出教案：只重新压缩替换过占位符的XML，其余部件复制模板中的压缩字节
+    DOCX_FAST_WRITE = os.getenv("DOCX_FAST_WRITE", "true").lower() in ("1", "true", "yes")
     
     # Web服务配置
     WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
@@ -26,7 +83,11 @@ class Config:
     # 文件路径配置
     UPLOAD_DIR = "web/uploads"
     OUTPUT_DIR = "lesson_plans"
-    CACHE_DIR = "cache"
+    CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+    
+    # 响应缓存配置
+    CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "256"))
     
     # 日志配置
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -35,13 +96,59 @@ class Config:
     # 必需的Python包
     REQUIRED_PACKAGES = [
         'fastapi', 'uvicorn', 'python-multipart', 'jinja2', 'aiofiles',
-        'python-docx', 'pandas', 'requests', 'openpyxl', 'tqdm'
+        'python-docx', 'pandas', 'requests', 'httpx', 'openpyxl', 'tqdm'
     ]
     
+    @classmethod
+    def get_ollama_hosts(cls) -> List[str]:
+        """获取全部Ollama服务地址（OLLAMA_HOST 按逗号拆分，去重）"""
+        hosts = []
+        for host in cls.OLLAMA_HOST.split(","):
+            host = host.strip().rstrip('/')
+            if host and host not in hosts:
+                hosts.append(host)
+        return hosts or ["http://localhost:11434"]
+    
+    @classmethod
+    def get_keep_alive(cls):
+        """keep_alive 参数：纯数字按秒数传递，其余按Ollama时长字符串传递"""
+        value = cls.OLLAMA_KEEP_ALIVE.strip()
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    
+    @classmethod
+    def get_field_models(cls) -> Dict[str, str]:
+        """字段到模型的路由表，格式错误的条目忽略"""
+        routes = {}
+        for entry in cls.OLLAMA_FIELD_MODELS.split(","):
+            field, sep, model = entry.partition("=")
+            if sep and field.strip() and model.strip():
+                routes[field.strip()] = model.strip()
+            elif entry.strip():
+                logging.getLogger(__name__).warning(f"OLLAMA_FIELD_MODELS 中的条目格式错误，已忽略: {entry}")
+        return routes
+    
+    @classmethod
+    def get_generation_mode(cls) -> str:
+        """生成模式，不是 GENERATION_MODES 之一时警告并使用 per_field"""
+        mode = cls.GENERATION_MODE.strip().lower()
+        if mode not in cls.GENERATION_MODES:
+            logging.getLogger(__name__).warning(
+                f"GENERATION_MODE 无效: {cls.GENERATION_MODE}（可选 {', '.join(cls.GENERATION_MODES)}），使用 per_field")
+            return "per_field"
+        return mode
+    
+    @classmethod
+    def get_num_ctx_buckets(cls) -> List[int]:
+        """num_ctx 可选档位（从小到大）"""
+        return sorted(int(size) for size in cls.OLLAMA_NUM_CTX_BUCKETS.split(",") if size.strip())
+    
     @classmethod
     def get_ollama_url(cls) -> str:
-        """获取完整的Ollama API URL"""
-        return f"{cls.OLLAMA_HOST.rstrip('/')}/api/generate"
+        """获取完整的Ollama API URL（多个地址时取第一个）"""
+        return f"{cls.get_ollama_hosts()[0]}/api/generate"
     
     @classmethod
     def setup_logging(cls):
@@ -57,9 +164,18 @@ class Config:
         return {
             "model": cls.OLLAMA_MODEL,
             "host": cls.OLLAMA_HOST,
+            "hosts": cls.get_ollama_hosts(),
             "url": cls.get_ollama_url(),
             "timeout": cls.OLLAMA_TIMEOUT,
-            "max_retries": cls.OLLAMA_MAX_RETRIES
+            "connect_timeout": cls.OLLAMA_CONNECT_TIMEOUT,
+            "max_retries": cls.OLLAMA_MAX_RETRIES,
+            "field_concurrency": cls.OLLAMA_FIELD_CONCURRENCY,
+            "max_inflight": cls.OLLAMA_MAX_INFLIGHT,
+            "generation_mode": cls.get_generation_mode(),
+            "warmup": cls.OLLAMA_WARMUP,
+            "keep_alive": cls.get_keep_alive(),
+            "think": cls.OLLAMA_THINK,
+            "field_models": cls.get_field_models()
         }
     
     @classmethod
@@ -92,12 +208,17 @@ def check_dependencies() -> bool:
     return True
 
 # 环境变量提示
-def print_config_info():
-    """打印配置信息"""
-    config = Config.validate_ollama_config()
+def print_config_info(config=None):
+    """
+    打印配置信息
+    :param config: validate_ollama_config 的结果，未提供时重新读取
+    """
+    config = config or Config.validate_ollama_config()
     
     if not os.getenv("OLLAMA_MODEL"):
         print(f"提示：未设置环境变量 OLLAMA_MODEL，使用默认值: {config['model']}")
     
     if not os.getenv("OLLAMA_HOST"):
-        print(f"提示：未设置环境变量 OLLAMA_HOST，使用默认值: {config['host']}")
\ No newline at end of file
+        print(f"提示：未设置环境变量 OLLAMA_HOST，使用默认值: {config['host']}")
+    
+    print(f"生成模式: {config['generation_mode']}")
@@ -1,32 +1,283 @@
 from docx import Document
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.opc.oxml import serialize_part_xml
+from docx.oxml.ns import qn
+import io
 import os
+import re
+import copy
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
 from tqdm import tqdm
+from config import Config
+from ai_generator import LESSON_FIELDS
+from batch_generator import BatchGenerator
+from docx_writer import TemplatePackage, UnsupportedPackageError
+
+logger = logging.getLogger(__name__)
+
+# 模板中的占位符，如 {{week}}、{{教学目标}}
+PLACEHOLDER_PATTERN = re.compile(r"\{\{([^{}]+)\}\}")
+# 由课程数据填充的占位符，其余可填充的占位符为 LESSON_FIELDS 中的AI字段
+LESSON_INFO_PLACEHOLDERS = ("week", "lesson", "course_name", "chapter_content", "class_hours")
+# 替换值中需要转换为 w:br / w:tab 的字符（与 python-docx 设置 run.text 时一致）
+_BREAK_PATTERN = re.compile(r"([\t\n\r])")
+
+W_P = qn('w:p')
+W_T = qn('w:t')
+XML_SPACE = '{http://www.w3.org/XML/1998/namespace}space'
+
+
+def _text_nodes(p):
+    """段落自身的 w:t 节点（不含文本框等嵌套段落中的），按文档顺序"""
+    nodes = []
+    for t in p.iter(W_T):
+        owner = t.getparent()
+        while owner is not None and owner.tag != W_P:
+            owner = owner.getparent()
+        if owner is p:
+            nodes.append(t)
+    return nodes
+
+
+def _set_text(t, text):
+    """设置 w:t 的文本，换行和制表符拆分为同一 run 中的 w:br / w:tab"""
+    pieces = _BREAK_PATTERN.split(text)
+    t.text = pieces[0]
+    t.set(XML_SPACE, 'preserve')
+    anchor = t
+    for i in range(1, len(pieces), 2):
+        mark = t.makeelement(qn('w:tab') if pieces[i] == '\t' else qn('w:br'), {})
+        anchor.addnext(mark)
+        anchor = mark
+        if pieces[i + 1]:
+            node = t.makeelement(W_T, {XML_SPACE: 'preserve'})
+            node.text = pieces[i + 1]
+            anchor.addnext(node)
+            anchor = node
+
+
+def substitute_placeholders(paragraphs, values):
+    """
+    单次扫描替换段落中的占位符，只改写占位符所在的 run，保留其余 run 的格式；
+    Word 把一个占位符拆到多个 run 中时，替换值写入占位符起始的 run，其余 run 中对应的部分删除
+    :param paragraphs: w:p 元素列表
+    :param values: 占位符名到替换文本的字典，不在其中的占位符保持原样
+    :return: 替换的占位符个数
+    """
+    count = 0
+    for p in paragraphs:
+        nodes = _text_nodes(p)
+        texts = [t.text or '' for t in nodes]
+        joined = ''.join(texts)
+        if '{{' not in joined:
+            continue
+        # 每个节点在段落文本中的起始位置
+        starts, offset = [], 0
+        for text in texts:
+            starts.append(offset)
+            offset += len(text)
+
+        def locate(pos, end=False):
+            """段落文本位置所在的节点序号和节点内偏移（end 为真时取结束位置所在的节点）"""
+            for i in range(len(texts) - 1, -1, -1):
+                if starts[i] < pos or (starts[i] == pos and not end):
+                    return i, pos - starts[i]
+            return 0, pos
+
+        changed = set()
+        # 从后往前替换，前面的位置不受影响
+        for match in reversed(list(PLACEHOLDER_PATTERN.finditer(joined))):
+            value = values.get(match.group(1))
+            if value is None:
+                continue
+            first, first_offset = locate(match.start())
+            last, last_offset = locate(match.end(), end=True)
+            if first == last:
+                texts[first] = texts[first][:first_offset] + value + texts[first][last_offset:]
+            else:
+                texts[first] = texts[first][:first_offset] + value
+                for i in range(first + 1, last):
+                    texts[i] = ''
+                texts[last] = texts[last][last_offset:]
+                changed.update(range(first + 1, last + 1))
+            changed.add(first)
+            count += 1
+        for i in sorted(changed):
+            _set_text(nodes[i], texts[i])
+    return count
+
+
+def _placeholder_parts(document):
+    """可能含占位符的部件：正文、页眉和页脚"""
+    parts = [document.part]
+    for rel in document.part.rels.values():
+        if not rel.is_external and rel.reltype in (RT.HEADER, RT.FOOTER):
+            parts.append(rel.target_part)
+    return parts
+
+
+class CompiledTemplate:
+    """已解析的教案模板：只读取和解析一次，记录占位符所在的段落，每节课使用内存中的副本"""
+
+    def __init__(self, data, path=None):
+        """
+        :param data: 模板文件（.docx）的内容
+        :param path: 模板路径，仅用于日志
+        """
+        self.path = path
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.document = Document(io.BytesIO(data))
+        # zip层面的快速写出；模板的zip结构不支持时（zip64、加密等）回退到 python-docx 保存
+        try:
+            self.package = TemplatePackage(data)
+        except UnsupportedPackageError as e:
+            logger.warning(f"模板 {path} 不支持快速写出，使用 python-docx 保存: {e}")
+            self.package = None
+        # 各部件（正文、页眉、页脚）中含占位符的段落在 w:p 遍历顺序中的位置，包括表格和嵌套表格中的段落
+        self.paragraph_index = {}
+        self.placeholders = {}
+        for part in _placeholder_parts(self.document):
+            for i, p in enumerate(part.element.iter(W_P)):
+                names = PLACEHOLDER_PATTERN.findall(''.join(t.text or '' for t in _text_nodes(p)))
+                if names:
+                    self.paragraph_index.setdefault(str(part.partname), []).append(i)
+                    for name in names:
+                        self.placeholders[name] = self.placeholders.get(name, 0) + 1
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            return cls(f.read(), path)
+
+    def inventory(self):
+        """
+        模板的占位符清单，与AI字段（prompt_templates 的键）取交集
+        :return: {"placeholders": 模板中的全部占位符, "fields": 需要AI生成的字段,
+                  "skipped_fields": 模板中没有占位符、无需生成的字段, "unknown": 无法填充的占位符}
+        """
+        return {
+            "placeholders": sorted(self.placeholders),
+            "fields": [field for field in LESSON_FIELDS if field in self.placeholders],
+            "skipped_fields": [field for field in LESSON_FIELDS if field not in self.placeholders],
+            "unknown": sorted(name for name in self.placeholders
+                              if name not in LESSON_FIELDS and name not in LESSON_INFO_PLACEHOLDERS)
+        }
+
+    @property
+    def paragraph_count(self):
+        """含占位符的段落数"""
+        return sum(len(indexes) for indexes in self.paragraph_index.values())
+
+    def clone(self):
+        """
+        复制一份可修改的文档，不重新读取和解析模板文件
+        :return: (文档副本, 含占位符的 w:p 元素列表)
+        """
+        doc = copy.deepcopy(self.document)
+        paragraphs = []
+        for part in _placeholder_parts(doc):
+            indexes = self.paragraph_index.get(str(part.partname))
+            if indexes:
+                elements = list(part.element.iter(W_P))
+                paragraphs.extend(elements[i] for i in indexes)
+        return doc, paragraphs
+
+    def clone_parts(self):
+        """
+        只复制含占位符的部件的XML，用于快速写出
+        :return: (zip成员名到XML根元素副本的字典, 含占位符的 w:p 元素列表)
+        """
+        parts, paragraphs = {}, []
+        for part in _placeholder_parts(self.document):
+            indexes = self.paragraph_index.get(str(part.partname))
+            if indexes:
+                element = copy.deepcopy(part.element)
+                parts[part.partname.membername] = element
+                elements = list(element.iter(W_P))
+                paragraphs.extend(elements[i] for i in indexes)
+        return parts, paragraphs
+
+    def save(self, parts, output_path):
+        """
+        快速写出：clone_parts() 得到的部件重新序列化（与 python-docx 保存时相同），其余部件复制模板中的压缩字节
+        :param parts: zip成员名到XML根元素的字典
+        :param output_path: 输出文件路径
+        """
+        self.package.write(output_path, {name: serialize_part_xml(element) for name, element in parts.items()})
+
+
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def get_compiled_template(template_path):
+    """
+    获取已编译的模板，按文件内容的哈希在进程内共享（模板文件被覆盖后会重新编译）
+    :param template_path: 模板文件路径
+    :return: CompiledTemplate
+    """
+    with open(template_path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    with _templates_lock:
+        template = _templates.get(digest)
+        if template is not None:
+            _templates.move_to_end(digest)
+            return template
+    template = CompiledTemplate(data, template_path)
+    logger.info(f"已编译模板 {template_path}: {template.paragraph_count} 个段落含占位符，"
+                f"占位符 {sorted(template.placeholders)}")
+    with _templates_lock:
+        template = _templates.setdefault(digest, template)
+        _templates.move_to_end(digest)
+        while len(_templates) > max(1, Config.TEMPLATE_CACHE_SIZE):
+            _templates.popitem(last=False)
+    return template
+
+
+# 渲染进程中的文档组装器，由 init_render_worker 在进程启动时创建
+_worker_builder = None
+
+
+def init_render_worker(template_path, fast_write, log_level=None):
+    """渲染进程的初始化函数：每个进程只加载和编译一次模板，日志级别与主进程一致"""
+    global _worker_builder
+    Config.setup_logging()
+    if log_level is not None:
+        logging.getLogger().setLevel(log_level)
+    _worker_builder = DocumentBuilder(template_path, fast_write)
+
+
+def render_in_worker(lesson_data, ai_generated_content, output_path):
+    """在渲染进程中生成单个教案文档，返回输出文件名"""
+    _worker_builder.build_lesson_plan(lesson_data, ai_generated_content, output_path)
+    return os.path.basename(output_path)
+
 
 class DocumentBuilder:
     """文档组装器：按周次和课次批量生成Word格式教案"""
     
-    def __init__(self, template_path):
+    def __init__(self, template_path, fast_write=None):
         """
         初始化文档组装器
         :param template_path: 教案模板文件路径
+        :param fast_write: 是否在zip层面直接写出教案，默认 Config.DOCX_FAST_WRITE
         """
         self.template_path = template_path
+        self.template = get_compiled_template(template_path)
+        self.fast_write = Config.DOCX_FAST_WRITE if fast_write is None else fast_write
+
+    def template_fields(self):
+        """
+        模板实际使用的AI字段
+        :return: (需要生成的字段, 模板中没有占位符而跳过的字段)
+        """
+        inventory = self.template.inventory()
+        return inventory["fields"], inventory["skipped_fields"]
 
-    def _replace_text_in_doc(self, doc, replacements):
-        """在文档的段落和表格中执行文本替换"""
-        for p in doc.paragraphs:
-            for key, value in replacements.items():
-                if key in p.text:
-                    p.text = p.text.replace(key, value)
-
-        for table in doc.tables:
-            for row in table.rows:
-                for cell in row.cells:
-                    for p in cell.paragraphs:
-                        for key, value in replacements.items():
-                            if key in p.text:
-                                p.text = p.text.replace(key, value)
-        
     def build_lesson_plan(self, lesson_data, ai_generated_content, output_path):
         """
         生成单个教案文档
@@ -35,54 +286,60 @@ class DocumentBuilder:
         :param output_path: 输出文件路径
         """
         try:
-            doc = Document(self.template_path)
+            fast = self.fast_write and self.template.package is not None
+            if fast:
+                parts, paragraphs = self.template.clone_parts()
+            else:
+                doc, paragraphs = self.template.clone()
             
-            # 准备替换数据
-            replacements = {
-                "{{week}}": str(lesson_data['week']),
-                "{{lesson}}": str(lesson_data['lesson']),
-                "{{course_name}}": lesson_data['课程名称'],
-                "{{chapter_content}}": lesson_data['章节内容'],
-                "{{class_hours}}": str(lesson_data['课时'])
+            # 准备替换数据（占位符名 → 文本）
+            values = {
+                "week": str(lesson_data['week']),
+                "lesson": str(lesson_data['lesson']),
+                "course_name": lesson_data['课程名称'],
+                "chapter_content": lesson_data['章节内容'],
+                "class_hours": str(lesson_data['课时'])
             }
             
             # 添加AI生成的内容
-            for field, content in ai_generated_content.items():
-                replacements[f"{{{{{field}}}}}"] = content
+            values.update(ai_generated_content)
             
             # 执行文本替换
-            self._replace_text_in_doc(doc, replacements)
+            substitute_placeholders(paragraphs, values)
             
             # 保存文档
-            doc.save(output_path)
+            if fast:
+                self.template.save(parts, output_path)
+            else:
+                doc.save(output_path)
             
         except Exception as e:
             print(f"生成教案失败: {e}")
             raise e
     
-    def build_batch_lesson_plans(self, schedule_data, ai_generator, syllabus_data=None):
+    def build_batch_lesson_plans(self, schedule_data, ai_generator, syllabus_data=None, use_cache=True, refresh_cache=False):
         """
         批量生成教案
         :param schedule_data: 教学进度表数据
         :param ai_generator: AI生成器实例
         :param syllabus_data: 教学大纲数据（可选）
+        :param use_cache: 是否读写响应缓存
+        :param refresh_cache: 丢弃已有缓存并重新生成
+        :return: 批量生成结果字典
         """
-        if not os.path.exists('lesson_plans'):
-            os.makedirs('lesson_plans')
+        progress = tqdm(total=len(schedule_data), desc="生成教案")
+        
+        def on_event(event):
+            if event["type"] == "lesson_completed":
+                progress.update(1)
+            elif event["type"] == "lesson_failed":
+                progress.update(1)
+                tqdm.write(f"生成{event['lesson']}教案失败: {event['error']}")
+            elif event["type"] == "backend_unavailable":
+                tqdm.write(f"Ollama服务暂不可用，约{event['retry_after']:.0f}秒后重试{event['lesson']}")
         
-        for lesson_data in tqdm(schedule_data, desc="生成教案"):
-            try:
-                # 生成AI内容
-                ai_content = {}
-                for field in ["单元教学目标", "教学重点", "教学难点", "教学方法", "教学过程", "作业布置"]:
-                    ai_content[field] = ai_generator.generate_content(field, lesson_data, syllabus_data)
-                
-                # 生成文档
-                output_filename = f"第{lesson_data['week']}周第{lesson_data['lesson']}次课教案.docx"
-                output_path = os.path.join('lesson_plans', output_filename)
-                
-                self.build_lesson_plan(lesson_data, ai_content, output_path)
-                
-            except Exception as e:
-                print(f"生成第{lesson_data['week']}周第{lesson_data['lesson']}次课教案失败: {e}")
-                continue
\ No newline at end of file
+        try:
+            batch = BatchGenerator(ai_generator, self, use_cache=use_cache, refresh_cache=refresh_cache)
+            return batch.run(schedule_data, syllabus_data, on_event=on_event)
+        finally:
+            progress.close()
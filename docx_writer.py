@@ -0,0 +1,122 @@
+import io
+import zlib
+import struct
+import zipfile
+
+# 未修改的部件（图片、样式、主题等）直接复制压缩后的字节，只有替换过占位符的XML重新压缩
+_DEFLATE_LEVEL = zlib.Z_DEFAULT_COMPRESSION
+# 通用标志位：1 加密，0x800 文件名为UTF-8（写出时不使用数据描述符）
+_FLAG_ENCRYPTED = 0x1
+_FLAG_UTF8 = 0x800
+# 单个zip（非zip64）的上限
+_ZIP32_LIMIT = 0xFFFFFFFF
+_ZIP32_MAX_ENTRIES = 0xFFFF
+
+
+class UnsupportedPackageError(ValueError):
+    """模板的zip结构不适合直接复制（zip64、加密或非 stored/deflate 压缩）"""
+
+
+class _Member:
+    """zip中的一个成员：原始的元数据和压缩后的字节"""
+
+    __slots__ = ("name", "date_time", "compress_type", "crc", "compress_size", "file_size", "raw",
+                 "external_attr", "create_system")
+
+    def __init__(self, info, raw):
+        self.name = info.filename
+        self.date_time = info.date_time
+        self.compress_type = info.compress_type
+        self.crc = info.CRC
+        self.compress_size = info.compress_size
+        self.file_size = info.file_size
+        self.raw = raw
+        self.external_attr = info.external_attr
+        self.create_system = info.create_system
+
+
+def _dos_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return ((year - 1980) << 9 | month << 5 | day), (hour << 11 | minute << 5 | second // 2)
+
+
+class TemplatePackage:
+    """docx模板的zip成员，按原始的压缩字节保存，写出时只重新压缩替换过的部件"""
+
+    def __init__(self, data):
+        """
+        :param data: 模板文件（.docx）的内容
+        :raises UnsupportedPackageError: zip结构不适合直接复制时
+        """
+        self.members = []
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            infos = archive.infolist()
+            if len(infos) >= _ZIP32_MAX_ENTRIES:
+                raise UnsupportedPackageError(f"成员过多: {len(infos)}")
+            for info in infos:
+                if info.flag_bits & _FLAG_ENCRYPTED:
+                    raise UnsupportedPackageError(f"{info.filename} 已加密")
+                if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                    raise UnsupportedPackageError(f"{info.filename} 的压缩方式不受支持: {info.compress_type}")
+                if max(info.file_size, info.compress_size, info.header_offset) >= _ZIP32_LIMIT:
+                    raise UnsupportedPackageError(f"{info.filename} 需要zip64")
+                # 本地文件头之后才是数据，文件名和扩展字段长度以本地文件头为准
+                header = struct.unpack(zipfile.structFileHeader,
+                                       data[info.header_offset:info.header_offset + zipfile.sizeFileHeader])
+                if header[0] != zipfile.stringFileHeader:
+                    raise UnsupportedPackageError(f"{info.filename} 的本地文件头无效")
+                start = info.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+                self.members.append(_Member(info, data[start:start + info.compress_size]))
+        self.names = {member.name for member in self.members}
+
+    def write(self, output_path, replaced):
+        """
+        写出docx：replaced 中的成员使用新内容，其余成员原样复制压缩后的字节
+        :param output_path: 输出文件路径
+        :param replaced: 成员名（如 word/document.xml）到新内容（bytes）的字典
+        """
+        unknown = set(replaced) - self.names
+        if unknown:
+            raise KeyError(f"模板中没有这些部件: {sorted(unknown)}")
+
+        chunks, central, offset = [], [], 0
+        for member in self.members:
+            content = replaced.get(member.name)
+            if content is None:
+                compress_type, crc = member.compress_type, member.crc
+                compress_size, file_size, raw = member.compress_size, member.file_size, member.raw
+            else:
+                compressor = zlib.compressobj(_DEFLATE_LEVEL, zlib.DEFLATED, -15)
+                raw = compressor.compress(content) + compressor.flush()
+                compress_type, crc = zipfile.ZIP_DEFLATED, zlib.crc32(content) & 0xFFFFFFFF
+                compress_size, file_size = len(raw), len(content)
+                if max(compress_size, file_size) >= _ZIP32_LIMIT:
+                    raise UnsupportedPackageError(f"{member.name} 需要zip64")
+
+            try:
+                name = member.name.encode("ascii")
+                flags = 0
+            except UnicodeEncodeError:
+                name = member.name.encode("utf-8")
+                flags = _FLAG_UTF8
+            dos_date, dos_time = _dos_time(member.date_time)
+            version = 20 if compress_type == zipfile.ZIP_DEFLATED else 10
+            header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader, version, 0, flags,
+                                 compress_type, dos_time, dos_date, crc, compress_size, file_size, len(name), 0)
+            chunks.extend((header, name, raw))
+            central.append(struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir, version,
+                                       member.create_system, version, 0, flags, compress_type, dos_time,
+                                       dos_date, crc, compress_size, file_size, len(name), 0, 0, 0, 0,
+                                       member.external_attr, offset) + name)
+            offset += len(header) + len(name) + len(raw)
+            if offset >= _ZIP32_LIMIT:
+                raise UnsupportedPackageError("输出需要zip64")
+
+        directory = b"".join(central)
+        end = struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, len(central), len(central),
+                          len(directory), offset, 0)
+        with open(output_path, "wb") as f:
+            f.writelines(chunks)
+            f.write(directory)
+            f.write(end)
+
@@ -0,0 +1,371 @@
+import json
+import time
+import random
+import argparse
+import threading
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import Config
+from prompt_budget import estimate_tokens
+
+# 模拟输出使用的文本，按需要的token数重复截取
+FILLER = "模拟生成的教案内容，用于压力测试和离线开发"
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal")
+
+
+class FakeOllama:
+    """
+    模拟Ollama服务：实现 /api/tags、/api/generate、/api/chat（含流式输出），
+    可配置延迟分布、生成速度、错误率和并发上限，用于在没有GPU的机器上测试调度、缓存和Web流程
+    """
+
+    def __init__(self, models=None, latency=0.2, latency_dist="fixed", jitter=0.25, tokens_per_second=50.0,
+                 prompt_tokens_per_second=1000.0, output_tokens=120, load_seconds=0.0, error_rate=0.0,
+                 max_concurrency=4, max_queue=512, think_tokens=0, seed=None):
+        """
+        :param models: 可用的模型名列表，默认 OLLAMA_MODEL 加上 OLLAMA_FIELD_MODELS 中的模型
+        :param latency: 每个请求开始输出前的固定开销（秒），按 latency_dist 随机
+        :param latency_dist: 延迟分布：fixed、uniform（±jitter）、normal（标准差 jitter×latency）、
+                             lognormal（中位数 latency，sigma 为 jitter）
+        :param jitter: 延迟分布的离散程度
+        :param tokens_per_second: 生成速度，0表示不等待
+        :param prompt_tokens_per_second: 提示词评估速度，0表示不等待；与上一次请求相同的前缀不再评估
+        :param output_tokens: 每个请求输出的token数（受 num_predict 限制）
+        :param load_seconds: 模型加载耗时；模型首次使用或 num_ctx 变化时重新加载
+        :param error_rate: 随机返回500错误的比例
+        :param max_concurrency: 同时处理的请求数（相当于 OLLAMA_NUM_PARALLEL），其余请求排队
+        :param max_queue: 排队请求数上限，超出后返回503（相当于 OLLAMA_MAX_QUEUE）
+        :param think_tokens: 请求未关闭 think 时在输出前附加的 <think> 内容token数
+        :param seed: 随机种子，固定后延迟和错误的序列可重复
+        """
+        if latency_dist not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"不支持的延迟分布: {latency_dist}")
+        self.models = list(models or dict.fromkeys([Config.OLLAMA_MODEL, *Config.get_field_models().values()]))
+        self.latency = latency
+        self.latency_dist = latency_dist
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.output_tokens = output_tokens
+        self.load_seconds = load_seconds
+        self.error_rate = error_rate
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max_queue
+        self.think_tokens = think_tokens
+        self._random = random.Random(seed)
+        self._slots = threading.Semaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        # 已加载的模型及其 num_ctx，以及各并行槽位最近评估过的提示词（用于前缀复用）
+        self._loaded = {}
+        self._recent_prompts = []
+        self._stats = {"requests": 0, "errors": 0, "rejected": 0, "loads": 0, "waiting": 0, "active": 0,
+                       "max_active": 0, "prompt_eval_tokens": 0, "eval_tokens": 0}
+        self._server = None
+
+    def stats(self):
+        """请求计数、排队和并发情况"""
+        with self._lock:
+            return dict(self._stats)
+
+    def _sample_latency(self):
+        with self._lock:
+            rng = self._random
+            if self.latency_dist == "uniform":
+                value = rng.uniform(self.latency * (1 - self.jitter), self.latency * (1 + self.jitter))
+            elif self.latency_dist == "normal":
+                value = rng.gauss(self.latency, self.latency * self.jitter)
+            elif self.latency_dist == "lognormal":
+                value = self.latency * rng.lognormvariate(0, self.jitter)
+            else:
+                value = self.latency
+        return max(0.0, value)
+
+    def _inject_error(self):
+        with self._lock:
+            return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def _load(self, model, num_ctx):
+        """模型首次使用或 num_ctx 变化时模拟加载，返回加载耗时（秒）"""
+        with self._lock:
+            reload = self._loaded.get(model, -1) != num_ctx
+            if reload:
+                self._loaded[model] = num_ctx
+                self._stats["loads"] += 1
+        if reload and self.load_seconds > 0:
+            time.sleep(self.load_seconds)
+            return self.load_seconds
+        return 0.0
+
+    def _prompt_eval_count(self, prompt):
+        """提示词中需要评估的token数：与最近请求相同的最长前缀视为已缓存"""
+        with self._lock:
+            common = max((self._common_prefix(prompt, previous) for previous in self._recent_prompts), default=0)
+            self._recent_prompts = ([prompt] + [p for p in self._recent_prompts if p != prompt])[:self.max_concurrency]
+        return max(1, estimate_tokens(prompt) - estimate_tokens(prompt[:common]))
+
+    @staticmethod
+    def _common_prefix(a, b):
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    @staticmethod
+    def _filler(tokens):
+        text = FILLER * (tokens // len(FILLER) + 1)
+        return text[:tokens]
+
+    def _output(self, body, tokens):
+        """按请求格式生成模拟输出：format 为 JSON Schema 时输出对应的JSON对象"""
+        schema = body.get("format")
+        if isinstance(schema, dict) and schema.get("properties"):
+            fields = list(schema["properties"])
+            share = max(1, tokens // len(fields))
+            return json.dumps({field: self._filler(share) for field in fields}, ensure_ascii=False)
+        if schema == "json":
+            return json.dumps({"content": self._filler(tokens)}, ensure_ascii=False)
+        text = self._filler(tokens)
+        if self.think_tokens and body.get("think") is not False:
+            text = f"<think>{self._filler(self.think_tokens)}</think>\n{text}"
+        return text
+
+    def generate(self, path, body, emit):
+        """
+        处理一次生成请求
+        :param path: /api/generate 或 /api/chat
+        :param body: 请求数据
+        :param emit: 输出一个响应字典（流式时每段调用一次）
+        :return: (状态码, 错误信息)，成功时为 (200, None)
+        """
+        model = body.get("model")
+        if model not in self.models:
+            return 404, f"model '{model}' not found"
+        with self._lock:
+            if self._stats["waiting"] >= self.max_queue:
+                self._stats["rejected"] += 1
+                return 503, "server busy, please try again.  maximum pending requests exceeded"
+            self._stats["waiting"] += 1
+        with self._slots:
+            with self._lock:
+                self._stats["waiting"] -= 1
+                self._stats["active"] += 1
+                self._stats["requests"] += 1
+                self._stats["max_active"] = max(self._stats["max_active"], self._stats["active"])
+            try:
+                return self._generate(path, body, model, emit)
+            finally:
+                with self._lock:
+                    self._stats["active"] -= 1
+
+    def _generate(self, path, body, model, emit):
+        start = time.perf_counter()
+        options = body.get("options") or {}
+        chat = path == "/api/chat"
+        if chat:
+            prompt = "".join(f"<{m.get('role')}>{m.get('content', '')}" for m in body.get("messages") or [])
+        else:
+            prompt = (body.get("system") or "") + (body.get("prompt") or "")
+        load = self._load(model, options.get("num_ctx"))
+
+        def message(text, done, **extra):
+            item = {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+            if chat:
+                item["message"] = {"role": "assistant", "content": text}
+            else:
+                item["response"] = text
+            item.update(extra)
+            return item
+
+        # 空提示词只加载模型（预热）
+        if not prompt.strip() or (chat and not body.get("messages")):
+            emit(message("", True, done_reason="load", total_duration=int((time.perf_counter() - start) * 1e9),
+                         load_duration=int(load * 1e9)))
+            return 200, None
+
+        if self._inject_error():
+            with self._lock:
+                self._stats["errors"] += 1
+            return 500, "fake_ollama: injected error"
+
+        prompt_tokens = self._prompt_eval_count(prompt)
+        eval_start = time.perf_counter()
+        delay = self._sample_latency()
+        if self.prompt_tokens_per_second > 0:
+            delay += prompt_tokens / self.prompt_tokens_per_second
+        time.sleep(delay)
+        prompt_eval = time.perf_counter() - eval_start
+
+        limit = options.get("num_predict")
+        tokens = self.output_tokens if not limit or limit < 0 else min(self.output_tokens, limit)
+        text = self._output(body, tokens)
+        gen_start = time.perf_counter()
+        if body.get("stream", True):
+            # 每个token一段，按生成速度输出；速度很快时合并输出，避免过多的小包
+            step = max(1, int(self.tokens_per_second // 100)) if self.tokens_per_second > 0 else len(text)
+            for i in range(0, len(text), step):
+                emit(message(text[i:i + step], False))
+                if self.tokens_per_second > 0:
+                    time.sleep(step / self.tokens_per_second)
+            text = ""
+        elif self.tokens_per_second > 0:
+            time.sleep(tokens / self.tokens_per_second)
+        eval_duration = time.perf_counter() - gen_start
+
+        with self._lock:
+            self._stats["prompt_eval_tokens"] += prompt_tokens
+            self._stats["eval_tokens"] += tokens
+        emit(message(
+            text, True,
+            done_reason="length" if limit and 0 < limit < self.output_tokens else "stop",
+            total_duration=int((time.perf_counter() - start) * 1e9),
+            load_duration=int(load * 1e9),
+            prompt_eval_count=prompt_tokens,
+            prompt_eval_duration=int(prompt_eval * 1e9),
+            eval_count=tokens,
+            eval_duration=int(eval_duration * 1e9)
+        ))
+        return 200, None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, obj, status=200):
+                data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == "/":
+                    data = b"Ollama is running"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; charset=utf-8")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                elif self.path == "/api/tags":
+                    self._send_json({"models": [{"name": name, "model": name} for name in fake.models]})
+                elif self.path == "/api/version":
+                    self._send_json({"version": "0.0.0-fake"})
+                elif self.path == "/fake/stats":
+                    self._send_json(fake.stats())
+                else:
+                    self._send_json({"error": "not found"}, 404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    body = json.loads(self.rfile.read(length) or b"{}")
+                except json.JSONDecodeError as e:
+                    self._send_json({"error": f"invalid JSON: {e}"}, 400)
+                    return
+                if self.path not in ("/api/generate", "/api/chat"):
+                    self._send_json({"error": "not found"}, 404)
+                    return
+
+                stream = body.get("stream", True)
+                state = {"started": False, "final": None}
+
+                def emit(item):
+                    if not stream:
+                        state["final"] = item
+                        return
+                    if not state["started"]:
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/x-ndjson")
+                        self.send_header("Transfer-Encoding", "chunked")
+                        self.end_headers()
+                        state["started"] = True
+                    line = (json.dumps(item, ensure_ascii=False) + "\n").encode("utf-8")
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                    self.wfile.flush()
+
+                try:
+                    status, error = fake.generate(self.path, body, emit)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端已断开
+                    return
+                if error is not None:
+                    self._send_json({"error": error}, status)
+                elif stream:
+                    self.wfile.write(b"0\r\n\r\n")
+                else:
+                    self._send_json(state["final"])
+
+        return Handler
+
+    def serve(self, host="127.0.0.1", port=11434):
+        """创建HTTP服务（未启动），port 为0时自动选择端口"""
+        server = ThreadingHTTPServer((host, port), self._handler())
+        server.daemon_threads = True
+        return server
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        在后台线程中启动服务
+        :return: 服务地址，如 http://127.0.0.1:54321
+        """
+        self._server = self.serve(host, port)
+        threading.Thread(target=self._server.serve_forever, name="fake-ollama", daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        """停止后台服务"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='模拟Ollama服务（压力测试和离线开发用）')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址')
+    parser.add_argument('--port', type=int, default=11434, help='监听端口')
+    parser.add_argument('--models', help='可用的模型，逗号分隔，默认 OLLAMA_MODEL 和 OLLAMA_FIELD_MODELS 中的模型')
+    parser.add_argument('--latency', type=float, default=0.2, help='每个请求开始输出前的开销（秒）')
+    parser.add_argument('--latency-dist', choices=LATENCY_DISTRIBUTIONS, default='fixed', help='延迟分布')
+    parser.add_argument('--jitter', type=float, default=0.25, help='延迟分布的离散程度')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help='生成速度，0表示不等待')
+    parser.add_argument('--prompt-tokens-per-second', type=float, default=1000.0, help='提示词评估速度，0表示不等待')
+    parser.add_argument('--output-tokens', type=int, default=120, help='每个请求输出的token数')
+    parser.add_argument('--load-seconds', type=float, default=0.0, help='模型加载耗时（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='随机返回500错误的比例')
+    parser.add_argument('--max-concurrency', type=int, default=4, help='同时处理的请求数，其余排队')
+    parser.add_argument('--max-queue', type=int, default=512, help='排队请求数上限，超出返回503')
+    parser.add_argument('--think-tokens', type=int, default=0, help='未关闭 think 时附加的思考过程token数')
+    parser.add_argument('--seed', type=int, help='随机种子')
+    args = parser.parse_args()
+
+    fake = FakeOllama(
+        models=[m.strip() for m in args.models.split(",") if m.strip()] if args.models else None,
+        latency=args.latency, latency_dist=args.latency_dist, jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second, prompt_tokens_per_second=args.prompt_tokens_per_second,
+        output_tokens=args.output_tokens, load_seconds=args.load_seconds, error_rate=args.error_rate,
+        max_concurrency=args.max_concurrency, max_queue=args.max_queue, think_tokens=args.think_tokens,
+        seed=args.seed
+    )
+    server = fake.serve(args.host, args.port)
+    print(f"模拟Ollama服务已启动: http://{args.host}:{args.port}")
+    print(f"可用模型: {', '.join(fake.models)}，延迟 {args.latency}s ({args.latency_dist})，"
+          f"{args.tokens_per_second} tokens/s，错误率 {args.error_rate:.0%}，并发 {fake.max_concurrency}")
+    print(f"使用方法: OLLAMA_HOST=http://{args.host}:{args.port} python main.py ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n模拟Ollama服务已停止")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
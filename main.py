@@ -26,6 +26,8 @@ def main():
     parser.add_argument('-y', '--syllabus', required=True, help='教学大纲文件路径')
     parser.add_argument('-t', '--template', required=True, help='教案模板文件路径')
     parser.add_argument('-w', '--weeks', help='周次范围，格式如"1-16"')
+    parser.add_argument('--no-cache', action='store_true', help='不读写AI响应缓存')
+    parser.add_argument('--refresh-cache', action='store_true', help='忽略已有缓存，重新生成并覆盖')
     
     # 解析命令行参数
     args = parser.parse_args()
@@ -53,11 +55,17 @@ def main():
     print("正在初始化AI生成器...")
     ai_generator = AIGenerator()
     print(f"使用模型: {ai_generator.model_name}")
-    print(f"Ollama服务地址: {ai_generator.base_url}")
+    if ai_generator.field_models:
+        print(f"字段模型路由: {ai_generator.field_models}，其余字段使用 {ai_generator.model_name}")
+    print(f"Ollama服务地址: {', '.join(ai_generator.hosts)}")
     
     # 初始化文档生成器
     print("正在初始化文档生成器...")
     doc_builder = DocumentBuilder(args.template)
+    fields, skipped_fields = doc_builder.template_fields()
+    print(f"模板使用的字段: {'、'.join(fields) or '无'}")
+    if skipped_fields:
+        print(f"模板中没有占位符，跳过生成: {'、'.join(skipped_fields)}")
     
     # 如果指定了周次范围，则过滤数据
     if args.weeks:
@@ -69,9 +77,30 @@ def main():
     
     # 生成教案
     print("正在生成教案...")
-    doc_builder.build_batch_lesson_plans(schedule_data, ai_generator)
+    result = doc_builder.build_batch_lesson_plans(
+        schedule_data, ai_generator, syllabus_data,
+        use_cache=not args.no_cache, refresh_cache=args.refresh_cache
+    )
     
-    print("教案生成完成！")
+    print(f"教案生成完成！成功 {len(result['completed'])} 个，失败 {len(result['failed'])} 个，"
+          f"平均 {result['lessons_per_minute']:.2f} 课/分钟")
+    if ai_generator.model_load_seconds is not None:
+        print(f"模型预热耗时 {ai_generator.model_load_seconds:.2f}s（不计入生成耗时），"
+              f"生成期间模型加载 {result['model_load_seconds']:.2f}s")
+    if ai_generator.generation_mode == "prefix":
+        print(f"复用课次前缀约节省提示词评估 {result['prompt_tokens_saved']} tokens")
+    if result['field_generations_skipped']:
+        print(f"跳过模板未使用的字段: 共少生成 {result['field_generations_skipped']} 个字段")
+    if result.get('plan'):
+        print(f"请求去重: 共 {result['plan']['requests']} 个请求，去重后 {result['plan']['unique']} 个，"
+              f"复用相同请求的结果 {result['requests_deduplicated']} 次")
+    for field, usage in ai_generator.field_usage_report().items():
+        limit = f"上限 {usage['num_predict']}，达到上限 {usage['capped']} 次" if usage['num_predict'] else "不限长度"
+        print(f"  {field} ({usage['model']}): {usage['requests']} 次请求，平均输出 {usage['avg_eval_tokens']} tokens（{limit}），"
+              f"去掉思考过程 {usage['think_chars']} 字符")
+    if ai_generator.cache is not None:
+        stats = ai_generator.cache.stats()
+        print(f"响应缓存: 命中 {stats['hits']} 次，未命中 {stats['misses']} 次，共 {stats['entries']} 条")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
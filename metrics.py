@@ -0,0 +1,211 @@
+import math
+import threading
+
+# 请求耗时直方图的分桶上限（秒）
+DURATION_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+# 首个token耗时直方图的分桶上限（秒）
+TTFT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+# 生成速度直方图的分桶上限（tokens/秒）
+TOKENS_PER_SECOND_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200)
+
+
+def _escape(value):
+    """转义标签值中的反斜杠、双引号和换行"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """带标签的指标，每组标签值对应一条时间序列"""
+
+    type_name = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        :param name: 指标名
+        :param documentation: 指标说明（HELP）
+        :param labelnames: 标签名列表
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counter 只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可任意设置的当前值"""
+
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+
+class Histogram(_Metric):
+    """分桶统计观测值的分布，同时记录总和与次数"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DURATION_BUCKETS):
+        """
+        :param buckets: 分桶上限，自动追加 +Inf
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+                    break
+            series["sum"] += value
+            series["count"] += 1
+
+    def _render_series(self, key, value):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets, value["counts"]):
+            cumulative += count
+            labels = _format_labels(self.labelnames, key, [("le", _format_value(bound))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(value['sum'])}")
+        lines.append(f"{self.name}_count{labels} {value['count']}")
+        return lines
+
+
+class Registry:
+    """进程内的指标注册表"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        输出全部指标
+        :return: Prometheus 文本格式（text/plain; version=0.0.4）
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# 生成请求：按字段、模型和处理请求的Ollama主机统计
+GENERATION_LABELS = ("field", "model", "backend")
+REQUESTS = REGISTRY.register(Counter(
+    "lesson_ai_requests_total", "完成的Ollama生成请求数", GENERATION_LABELS))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "lesson_ai_request_duration_seconds", "Ollama报告的单次请求总耗时（total_duration）", GENERATION_LABELS))
+LOAD_SECONDS = REGISTRY.register(Counter(
+    "lesson_ai_load_seconds_total", "请求中模型加载的累计耗时（load_duration）", GENERATION_LABELS))
+PROMPT_EVAL_TOKENS = REGISTRY.register(Counter(
+    "lesson_ai_prompt_eval_tokens_total", "评估的提示词token数（prompt_eval_count）", GENERATION_LABELS))
+PROMPT_EVAL_SECONDS = REGISTRY.register(Counter(
+    "lesson_ai_prompt_eval_seconds_total", "提示词评估的累计耗时（prompt_eval_duration）", GENERATION_LABELS))
+EVAL_TOKENS = REGISTRY.register(Counter(
+    "lesson_ai_eval_tokens_total", "生成的token数（eval_count）", GENERATION_LABELS))
+EVAL_SECONDS = REGISTRY.register(Counter(
+    "lesson_ai_eval_seconds_total", "生成token的累计耗时（eval_duration）", GENERATION_LABELS))
+TOKENS_PER_SECOND = REGISTRY.register(Histogram(
+    "lesson_ai_eval_tokens_per_second", "单次请求的生成速度（eval_count / eval_duration）", GENERATION_LABELS,
+    buckets=TOKENS_PER_SECOND_BUCKETS))
+TIME_TO_FIRST_TOKEN = REGISTRY.register(Histogram(
+    "lesson_ai_time_to_first_token_seconds", "流式请求的首个token耗时", GENERATION_LABELS, buckets=TTFT_BUCKETS))
+
+# Ollama主机：失败次数、在途请求数和熔断状态
+BACKEND_ERRORS = REGISTRY.register(Counter(
+    "lesson_ai_backend_errors_total", "Ollama请求失败次数（含会重试的暂时性错误）", ("backend", "kind")))
+BACKEND_OUTSTANDING = REGISTRY.register(Gauge(
+    "lesson_ai_backend_outstanding_requests", "各Ollama主机当前在途的请求数", ("backend",)))
+BACKEND_BREAKER_OPEN = REGISTRY.register(Gauge(
+    "lesson_ai_backend_breaker_open", "各Ollama主机是否处于熔断状态（1为熔断）", ("backend",)))
+
+
+def record_generation(field, model, result):
+    """
+    记录一次生成请求的Ollama耗时统计（时长字段单位为纳秒）
+    :param field: 字段名
+    :param model: 模型名
+    :param result: Ollama响应，带有 OllamaClient 补充的 host 和流式请求的 ttft
+    """
+    labels = {"field": field or "", "model": model or "", "backend": result.get("host") or ""}
+    REQUESTS.inc(**labels)
+    if result.get("total_duration"):
+        REQUEST_DURATION.observe(result["total_duration"] / 1e9, **labels)
+    if result.get("load_duration"):
+        LOAD_SECONDS.inc(result["load_duration"] / 1e9, **labels)
+    if result.get("prompt_eval_count"):
+        PROMPT_EVAL_TOKENS.inc(result["prompt_eval_count"], **labels)
+    if result.get("prompt_eval_duration"):
+        PROMPT_EVAL_SECONDS.inc(result["prompt_eval_duration"] / 1e9, **labels)
+    if result.get("eval_count"):
+        EVAL_TOKENS.inc(result["eval_count"], **labels)
+    if result.get("eval_duration"):
+        EVAL_SECONDS.inc(result["eval_duration"] / 1e9, **labels)
+        if result.get("eval_count"):
+            TOKENS_PER_SECOND.observe(result["eval_count"] / (result["eval_duration"] / 1e9), **labels)
+    if result.get("ttft") is not None:
+        TIME_TO_FIRST_TOKEN.observe(result["ttft"], **labels)
+
+
+def record_backend_error(backend, error):
+    """记录一次Ollama请求失败，kind 为错误类型名"""
+    BACKEND_ERRORS.inc(backend=backend, kind=type(error).__name__)
@@ -0,0 +1,659 @@
+import json
+import time
+import random
+import asyncio
+import inspect
+import logging
+import threading
+import weakref
+import contextlib
+from collections import deque
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from config import Config
+from metrics import record_backend_error
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaError(Exception):
+    """调用Ollama API失败"""
+
+
+class OllamaHTTPError(OllamaError):
+    """Ollama返回了非2xx状态码"""
+
+    def __init__(self, status_code, body, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+
+
+class OllamaTimeoutError(OllamaError):
+    """连接或读取超时"""
+
+
+class OllamaConnectionError(OllamaError):
+    """网络错误，无法与Ollama建立连接"""
+
+
+class OllamaUnavailableError(OllamaError):
+    """熔断器已打开，Ollama被判定为暂不可用，请求没有发出"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_transient(error):
+    """超时、连接失败、429 和 5xx 视为暂时性错误，可以重试"""
+    if isinstance(error, (OllamaTimeoutError, OllamaConnectionError)):
+        return True
+    return isinstance(error, OllamaHTTPError) and (error.status_code == 429 or error.status_code >= 500)
+
+
+def backoff_delay(attempt):
+    """
+    第 attempt 次重试前的等待时间：指数退避，并在 [0, 上限] 内随机取值，避免并发请求同时重试
+    :param attempt: 已失败的次数，从0开始
+    :return: 等待秒数
+    """
+    ceiling = min(Config.OLLAMA_RETRY_BACKOFF_MAX, Config.OLLAMA_RETRY_BACKOFF * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """熔断器：连续失败达到阈值后快速失败，冷却时间过后放行一个探测请求，探测成功即恢复"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # 探测请求进行中时，其他请求建议的等待时间（秒）
+    PROBE_RETRY_AFTER = 1.0
+
+    def __init__(self, name, threshold=None, cooldown=None):
+        """
+        :param name: 名称，用于日志（一般为Ollama地址）
+        :param threshold: 触发熔断的连续失败次数，默认 Config.OLLAMA_BREAKER_THRESHOLD
+        :param cooldown: 熔断后的冷却秒数，默认 Config.OLLAMA_BREAKER_COOLDOWN
+        """
+        self.name = name
+        self.threshold = max(1, threshold or Config.OLLAMA_BREAKER_THRESHOLD)
+        self.cooldown = cooldown if cooldown is not None else Config.OLLAMA_BREAKER_COOLDOWN
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _remaining(self):
+        return max(0.0, self._opened_at + self.cooldown - time.monotonic())
+
+    def retry_after(self):
+        """距离允许下一次请求的秒数，未熔断时为0"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return self._remaining()
+            if self.state == self.HALF_OPEN and self._probing:
+                return self.PROBE_RETRY_AFTER
+            return 0.0
+
+    def before_request(self):
+        """请求发出前调用；熔断中抛出 OllamaUnavailableError"""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._remaining()
+                if remaining > 0:
+                    raise OllamaUnavailableError(
+                        f"Ollama服务 {self.name} 暂不可用（连续失败{self.failures}次），{remaining:.0f}秒后重试",
+                        remaining)
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise OllamaUnavailableError(f"正在探测Ollama服务 {self.name} 是否恢复", self.PROBE_RETRY_AFTER)
+                self._probing = True
+
+    def record_success(self):
+        """请求成功，或服务可达但返回了非暂时性错误"""
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"Ollama服务 {self.name} 已恢复，关闭熔断")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        """请求遇到暂时性错误"""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Ollama服务 {self.name} 连续失败{self.failures}次，熔断{self.cooldown:.0f}秒")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+    def release(self):
+        """请求被取消，不计入成功或失败"""
+        with self._lock:
+            self._probing = False
+
+    def is_open(self):
+        with self._lock:
+            return self.state == self.OPEN and self._remaining() > 0
+
+
+# 进程内所有客户端共享的连接池和请求槽位
+_session = None
+_session_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()
+# 各事件循环中正在使用共享客户端的过程数（async_client_session）
+_async_client_users = weakref.WeakKeyDictionary()
+_request_slots = {}
+_slots_lock = threading.Lock()
+_breakers = {}
+_breakers_lock = threading.Lock()
+# 每个主机当前在途的请求数（含排队等待槽位的请求），用于多主机负载均衡
+_outstanding = {}
+
+
+def get_timeout():
+    """(连接超时, 读取超时)，取自 Config"""
+    return (Config.OLLAMA_CONNECT_TIMEOUT, Config.OLLAMA_TIMEOUT)
+
+
+def get_session():
+    """获取共享的 requests.Session，连接保持长连接并按主机复用"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_connections 为保留的主机连接池个数，少于主机数时负载均衡轮换主机会淘汰连接池、关闭长连接；
+                # pool_block=True：单个主机的连接数达到上限时排队，而不是临时创建新连接
+                adapter = HTTPAdapter(pool_connections=max(4, len(Config.get_ollama_hosts())),
+                                      pool_maxsize=Config.OLLAMA_POOL_MAXSIZE, pool_block=True)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _session = session
+    return _session
+
+
+def get_async_client():
+    """获取当前事件循环共享的 httpx.AsyncClient"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        connect_timeout, read_timeout = get_timeout()
+        # httpx 的连接数上限作用于整个客户端，按主机数放大，保证每个主机都有 OLLAMA_POOL_MAXSIZE 个连接
+        max_connections = Config.OLLAMA_POOL_MAXSIZE * max(1, len(Config.get_ollama_hosts()))
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+class _HostSlots:
+    """
+    一个主机的在途请求槽位（async with），各事件循环中的请求共用同一个上限，槽位按等待的先后顺序分配
+    """
+
+    def __init__(self, limit):
+        self._lock = threading.Lock()
+        self._free = limit
+        # 等待方：(事件循环, Future)
+        self._waiters = deque()
+
+    def _acquire_or_wait(self, waiter):
+        """有空闲槽位且无人排队时直接占用并返回True，否则加入等待队列"""
+        with self._lock:
+            if self._free > 0 and not self._waiters:
+                self._free -= 1
+                return True
+            self._waiters.append(waiter)
+            return False
+
+    def release(self):
+        """释放一个槽位：交给最早的等待方，没有等待方时归还"""
+        with self._lock:
+            while self._waiters:
+                loop, future = self._waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self._hand_over, future)
+                    return
+                except RuntimeError:
+                    # 等待方的事件循环已关闭，交给下一个等待方
+                    continue
+            self._free += 1
+
+    def _hand_over(self, future):
+        # 在等待方的事件循环中执行；等待方已取消时把槽位继续交出去
+        if future.done():
+            self.release()
+        else:
+            future.set_result(None)
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        if self._acquire_or_wait(waiter):
+            return self
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            # 已经拿到槽位后才被取消时归还；槽位还在交接途中时由 _hand_over 归还
+            if not queued and waiter[1].done() and not waiter[1].cancelled():
+                self.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+@contextlib.asynccontextmanager
+async def async_client_session():
+    """
+    在一段过程（如一次批量生成）中使用当前事件循环共享的 httpx.AsyncClient，
+    同一事件循环中最后一个使用者结束时关闭客户端和其中的长连接
+    """
+    loop = asyncio.get_running_loop()
+    _async_client_users[loop] = _async_client_users.get(loop, 0) + 1
+    try:
+        yield
+    finally:
+        _async_client_users[loop] -= 1
+        if not _async_client_users[loop]:
+            del _async_client_users[loop]
+            client = _async_clients.pop(loop, None)
+            if client is not None:
+                await client.aclose()
+
+
+def run_sync(coro):
+    """在新的事件循环中运行协程（同步调用的入口），结束时关闭该事件循环的 httpx 客户端"""
+    async def main():
+        async with async_client_session():
+            return await coro
+    return asyncio.run(main())
+
+
+def _get_request_slots(host):
+    """指定主机的请求槽位，每个主机最多 OLLAMA_MAX_INFLIGHT 个在途请求"""
+    with _slots_lock:
+        slots = _request_slots.get(host)
+        if slots is None:
+            slots = _request_slots[host] = _HostSlots(max(1, Config.OLLAMA_MAX_INFLIGHT))
+        return slots
+
+
+def get_circuit_breaker(host):
+    """获取指定Ollama地址的熔断器，同一地址在进程内共享"""
+    with _breakers_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = _breakers[host] = CircuitBreaker(host)
+        return breaker
+
+
+class OllamaClient:
+    """Ollama API客户端：所有实例共享连接池、超时配置、在途请求上限和熔断状态"""
+
+    def __init__(self, host=None, max_retries=None):
+        """
+        :param host: Ollama服务地址，默认 Config.OLLAMA_HOST
+        :param max_retries: 暂时性错误的重试次数，默认 Config.OLLAMA_MAX_RETRIES
+        """
+        self.host = (host or Config.OLLAMA_HOST).rstrip('/')
+        self.max_retries = max(0, max_retries if max_retries is not None else Config.OLLAMA_MAX_RETRIES)
+        self.breaker = get_circuit_breaker(self.host)
+
+    def _url(self, path):
+        return f"{self.host}{path}"
+
+    def _after_failure(self, error, attempt, can_retry):
+        """
+        记录一次失败的请求，决定是否重试
+        :return: 重试前需要等待的秒数；不再重试时直接抛出异常
+        """
+        record_backend_error(self.host, error)
+        if not is_transient(error):
+            # 服务可达，只是请求本身有问题（如模型不存在），重试没有意义
+            self.breaker.record_success()
+            raise error
+        self.breaker.record_failure()
+        if self.breaker.is_open():
+            raise OllamaUnavailableError(f"{error}（Ollama服务 {self.host} 已熔断）",
+                                         self.breaker.retry_after()) from error
+        if attempt >= self.max_retries or not can_retry():
+            raise error
+        delay = backoff_delay(attempt)
+        logger.warning(f"请求Ollama失败: {error}，{delay:.1f}秒后第{attempt + 1}次重试")
+        return delay
+
+    async def _awith_retries(self, send, can_retry=lambda: True):
+        """
+        发送请求，遇到暂时性错误时按指数退避重试
+        :param send: 发送一次请求的协程函数
+        :param can_retry: 返回False时不再重试（如流式输出已经交给了调用方）
+        """
+        attempt = 0
+        while True:
+            self.breaker.before_request()
+            try:
+                result = await send()
+            except OllamaError as e:
+                await asyncio.sleep(self._after_failure(e, attempt, can_retry))
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return result
+
+    @staticmethod
+    def _parse(status_code, text, url):
+        """检查状态码并解析JSON响应"""
+        if status_code >= 400:
+            raise OllamaHTTPError(status_code, text, f"{status_code} Error for url: {url}")
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError as e:
+            raise OllamaError(f"解析API响应时出错: {e}") from e
+
+    def get(self, path, timeout=None):
+        """
+        发送GET请求
+        :param path: API路径，如 /api/tags
+        :param timeout: 超时秒数，默认使用 Config 中的连接/读取超时
+        :return: 解析后的JSON
+        """
+        url = self._url(path)
+        try:
+            response = get_session().get(url, timeout=timeout or get_timeout())
+        except requests.exceptions.Timeout as e:
+            raise OllamaTimeoutError(str(e)) from e
+        except requests.exceptions.RequestException as e:
+            raise OllamaConnectionError(str(e)) from e
+        return self._parse(response.status_code, response.text, url)
+
+    async def apost(self, path, payload):
+        """
+        发送POST请求，受进程内在途请求上限约束
+        :param path: API路径，如 /api/generate
+        :param payload: 请求数据
+        :return: 解析后的JSON，额外包含实际处理请求的主机 host
+        """
+        url = self._url(path)
+
+        async def send():
+            try:
+                async with _get_request_slots(self.host):
+                    response = await get_async_client().post(url, json=payload)
+            except httpx.TimeoutException as e:
+                raise OllamaTimeoutError(str(e)) from e
+            except httpx.RequestError as e:
+                raise OllamaConnectionError(str(e)) from e
+            return dict(self._parse(response.status_code, response.text, url), host=self.host)
+        return await self._awith_retries(send)
+
+    @staticmethod
+    def _merge_chunk(state, line):
+        """
+        合并流式响应中的一行NDJSON
+        :param state: 累积状态 {"pieces": [...], "final": dict, "ttft": float}
+        :return: (本行新增的文本, 本行解析后的字典)
+        """
+        try:
+            chunk = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise OllamaError(f"解析流式响应时出错: {e}") from e
+        if chunk.get("error"):
+            raise OllamaError(chunk["error"])
+        # /api/generate 返回 response，/api/chat 返回 message.content
+        piece = chunk.get("response") or (chunk.get("message") or {}).get("content") or ""
+        if piece:
+            if state["ttft"] is None:
+                state["ttft"] = time.perf_counter() - state["start"]
+            state["pieces"].append(piece)
+        if chunk.get("done"):
+            state["final"] = chunk
+        return piece, chunk
+
+    @staticmethod
+    def _stream_result(state):
+        """流式响应结束后拼出与非流式调用相同结构的结果"""
+        result = dict(state["final"] or {})
+        text = "".join(state["pieces"])
+        if "message" in result:
+            result["message"] = dict(result["message"], content=text)
+        else:
+            result["response"] = text
+        result["ttft"] = state["ttft"]
+        return result
+
+    async def astream(self, path, payload, on_chunk=None):
+        """
+        以流式方式发送POST请求，逐行读取NDJSON
+        :param path: API路径
+        :param payload: 请求数据（stream 会被设为True）
+        :param on_chunk: 每收到一段文本时回调 on_chunk(文本, 原始字典)，可以是协程函数
+        :return: 合并后的完整结果，额外包含首个token的耗时 ttft（秒）和处理请求的主机 host
+        """
+        url = self._url(path)
+        payload = dict(payload, stream=True)
+        # 已经回调过的文本无法撤回，此后出错不再重试
+        delivered = {"any": False}
+
+        async def send():
+            state = {"pieces": [], "final": None, "ttft": None, "start": time.perf_counter()}
+            try:
+                async with _get_request_slots(self.host):
+                    async with get_async_client().stream("POST", url, json=payload) as response:
+                        if response.status_code >= 400:
+                            body = (await response.aread()).decode("utf-8", "replace")
+                            raise OllamaHTTPError(response.status_code, body,
+                                                  f"{response.status_code} Error for url: {url}")
+                        async for line in response.aiter_lines():
+                            if not line:
+                                continue
+                            piece, chunk = self._merge_chunk(state, line)
+                            if on_chunk and (piece or chunk.get("done")):
+                                delivered["any"] = True
+                                outcome = on_chunk(piece, chunk)
+                                if inspect.isawaitable(outcome):
+                                    await outcome
+            except httpx.TimeoutException as e:
+                raise OllamaTimeoutError(str(e)) from e
+            except httpx.RequestError as e:
+                raise OllamaConnectionError(str(e)) from e
+            return dict(self._stream_result(state), host=self.host)
+        return await self._awith_retries(send, can_retry=lambda: not delivered["any"])
+
+
+class OllamaHostPool:
+    """
+    多个Ollama主机组成的客户端池，接口与 OllamaClient 相同
+    每个请求发往在途请求最少的健康主机；主机熔断后暂时剔除，冷却结束后由探测请求重新加入
+    """
+
+    def __init__(self, hosts, max_retries=None):
+        """
+        :param hosts: Ollama服务地址列表
+        :param max_retries: 暂时性错误的重试次数（换主机重试），默认 Config.OLLAMA_MAX_RETRIES
+        """
+        # 成员客户端不自行重试，失败后由池换一台主机
+        self.clients = [OllamaClient(host, max_retries=0) for host in hosts]
+        self.hosts = [client.host for client in self.clients]
+        self.host = self.hosts[0]
+        self.max_retries = max(0, max_retries if max_retries is not None else Config.OLLAMA_MAX_RETRIES)
+
+    def _acquire(self, exclude):
+        """
+        选出在途请求最少的可用主机并占用一个计数
+        :param exclude: 本次调用中已失败过的主机
+        :return: 成员客户端，没有可选主机时返回None
+        """
+        with _breakers_lock:
+            candidates = [c for c in self.clients if c.host not in exclude and c.breaker.retry_after() == 0]
+            if not candidates:
+                return None
+            # 连续失败次数计入负载，出错的主机少分配但仍会被请求到，直到恢复或熔断；
+            # 负载相同时随机选，避免总压在第一台
+            client = min(candidates, key=lambda c: (_outstanding.get(c.host, 0) + c.breaker.failures,
+                                                    random.random()))
+            _outstanding[client.host] = _outstanding.get(client.host, 0) + 1
+            return client
+
+    @staticmethod
+    def _release(client):
+        with _breakers_lock:
+            _outstanding[client.host] -= 1
+
+    def _unavailable(self):
+        """全部主机都不可用时的异常"""
+        retry_after = min(c.breaker.retry_after() for c in self.clients)
+        return OllamaUnavailableError(f"全部 {len(self.clients)} 个Ollama服务暂不可用，{retry_after:.0f}秒后重试",
+                                      retry_after)
+
+    def _next_client(self, tried, failures):
+        """
+        选出下一台主机；所有可用主机都试过后清空记录，退避后开始新一轮
+        :return: (成员客户端, 开始请求前需要等待的秒数)
+        """
+        client = self._acquire(tried)
+        if client is not None:
+            return client, 0.0
+        tried.clear()
+        client = self._acquire(tried)
+        if client is None:
+            raise self._unavailable()
+        return client, backoff_delay(max(0, failures - 1))
+
+    def _should_retry(self, error, failures, can_retry):
+        retryable = is_transient(error) or isinstance(error, OllamaUnavailableError)
+        return retryable and failures < self.max_retries and can_retry()
+
+    def _dispatch(self, call, can_retry=lambda: True):
+        """
+        把请求分配到某台主机，遇到暂时性错误时换主机重试
+        :param call: call(成员客户端) 发送一次请求
+        """
+        tried, failures = set(), 0
+        while True:
+            client, delay = self._next_client(tried, failures)
+            try:
+                if delay:
+                    time.sleep(delay)
+                return call(client)
+            except OllamaError as e:
+                if not self._should_retry(e, failures, can_retry):
+                    raise
+                failures += 1
+                tried.add(client.host)
+                logger.warning(f"Ollama服务 {client.host} 请求失败: {e}，换一台主机重试（第{failures}次）")
+            finally:
+                self._release(client)
+
+    async def _adispatch(self, call, can_retry=lambda: True):
+        """_dispatch 的异步版本，call 返回协程"""
+        tried, failures = set(), 0
+        while True:
+            client, delay = self._next_client(tried, failures)
+            try:
+                if delay:
+                    await asyncio.sleep(delay)
+                return await call(client)
+            except OllamaError as e:
+                if not self._should_retry(e, failures, can_retry):
+                    raise
+                failures += 1
+                tried.add(client.host)
+                logger.warning(f"Ollama服务 {client.host} 请求失败: {e}，换一台主机重试（第{failures}次）")
+            finally:
+                self._release(client)
+
+    def get(self, path, timeout=None):
+        """发送GET请求到任一可用主机"""
+        return self._dispatch(lambda client: client.get(path, timeout))
+
+    async def apost(self, path, payload):
+        """发送POST请求到在途请求最少的主机"""
+        return await self._adispatch(lambda client: client.apost(path, payload))
+
+    async def astream(self, path, payload, on_chunk=None):
+        """以流式方式发送POST请求，已经输出过文本后不再换主机重试；on_chunk 可以是协程函数"""
+        delivered = {"any": False}
+
+        def forward(piece, chunk):
+            delivered["any"] = True
+            return on_chunk(piece, chunk)
+        callback = forward if on_chunk else None
+        return await self._adispatch(lambda client: client.astream(path, payload, callback),
+                                     can_retry=lambda: not delivered["any"])
+
+
+async def awarm_up_model(host, model, keep_alive=None, num_ctx=None):
+    """
+    预热模型：发送不带提示词的生成请求，让Ollama把模型加载到显存
+    :param host: Ollama服务地址
+    :param model: 模型名称
+    :param keep_alive: 模型保持加载的时长，默认 Config.get_keep_alive()
+    :param num_ctx: 加载时使用的上下文长度，应与后续请求一致，否则Ollama会重新加载模型
+    :return: 模型加载耗时（秒）；Ollama未返回 load_duration 时为请求总耗时
+    """
+    payload = {
+        "model": model,
+        "stream": False,
+        "keep_alive": keep_alive if keep_alive is not None else Config.get_keep_alive()
+    }
+    if num_ctx:
+        payload["options"] = {"num_ctx": num_ctx}
+    start = time.perf_counter()
+    result = await OllamaClient(host).apost("/api/generate", payload)
+    elapsed = time.perf_counter() - start
+    if result.get("load_duration"):
+        return result["load_duration"] / 1e9
+    return elapsed
+
+
+def create_client(hosts=None, max_retries=None):
+    """
+    按地址数量创建客户端
+    :param hosts: Ollama服务地址列表，默认 Config.get_ollama_hosts()
+    :param max_retries: 暂时性错误的重试次数
+    :return: 单个地址时为 OllamaClient，多个地址时为 OllamaHostPool
+    """
+    hosts = hosts or Config.get_ollama_hosts()
+    if len(hosts) == 1:
+        return OllamaClient(hosts[0], max_retries)
+    return OllamaHostPool(hosts, max_retries)
+
+
+def host_health():
+    """
+    各Ollama主机的健康状态
+    :return: 列表，每项包含地址、熔断状态、连续失败次数和在途请求数
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+        outstanding = dict(_outstanding)
+    return [{
+        "host": breaker.name,
+        "state": breaker.state,
+        "failures": breaker.failures,
+        "retry_after": round(breaker.retry_after(), 1),
+        "outstanding": outstanding.get(breaker.name, 0)
+    } for breaker in breakers]
@@ -0,0 +1,127 @@
+import re
+import math
+import logging
+import threading
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_CJK = re.compile(r"[\u4e00-\u9fff\u3000-\u303f\uff00-\uffef]")
+
+# 非中文字符平均每个token对应的字符数
+CHARS_PER_TOKEN = 4
+# 估算误差的安全余量
+ESTIMATE_MARGIN = 1.1
+
+# 各字段输出的预留token数，同时作为该字段默认的 num_predict 上限，未列出的字段使用默认值
+FIELD_OUTPUT_TOKENS = {
+    "单元教学目标": 300,
+    "教学重点": 250,
+    "教学难点": 200,
+    "教学活动": 1200,
+    "作业布置": 400,
+    "教学资源": 400,
+    "教学反思": 400,
+    "教学评价": 400,
+}
+DEFAULT_OUTPUT_TOKENS = 600
+
+
+def estimate_tokens(text):
+    """
+    粗略估算文本的token数：中文字符和全角标点按每字一个token，其余字符按每4个一个token
+    :param text: 文本
+    :return: 估算的token数
+    """
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens, suffix="……"):
+    """
+    把文本截断到token预算以内，保留开头部分
+    :param text: 文本
+    :param max_tokens: token预算
+    :param suffix: 截断后追加的标记
+    :return: (截断后的文本, 是否发生了截断)
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text, False
+    budget = max(0, max_tokens - estimate_tokens(suffix))
+    used = 0.0
+    for i, char in enumerate(text):
+        used += 1 if _CJK.match(char) else 1 / CHARS_PER_TOKEN
+        if used > budget:
+            return text[:i].rstrip() + suffix, True
+    return text, False
+
+
+def output_tokens(fields):
+    """
+    生成指定字段需要预留的输出token数
+    :param fields: 字段名或字段列表
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    return sum(FIELD_OUTPUT_TOKENS.get(field, DEFAULT_OUTPUT_TOKENS) for field in fields)
+
+
+class NumCtxSizer:
+    """
+    为每个请求选择足够容纳提示词和输出的最小 num_ctx 档位
+    Ollama 在 num_ctx 变化时会重新加载模型，因此进程内只升不降：
+    已经用过较大的档位后，较短的提示词也沿用该档位，避免模型反复重载
+    """
+
+    def __init__(self, buckets=None):
+        """
+        :param buckets: 可选的 num_ctx 档位，默认 Config.get_num_ctx_buckets()
+        """
+        self.buckets = sorted(buckets or Config.get_num_ctx_buckets())
+        self.current = self.buckets[0]
+        self._lock = threading.Lock()
+
+    def pick(self, prompt_tokens, reserve_tokens):
+        """
+        :param prompt_tokens: 提示词的估算token数
+        :param reserve_tokens: 输出预留的token数
+        :return: (num_ctx, 是否超出最大档位)
+        """
+        needed = math.ceil((prompt_tokens + reserve_tokens) * ESTIMATE_MARGIN)
+        fit = next((size for size in self.buckets if size >= needed), None)
+        with self._lock:
+            if fit is not None and fit > self.current:
+                logger.info(f"num_ctx 从 {self.current} 提升到 {fit}（需要约 {needed} tokens）")
+                self.current = fit
+            return self.current, fit is None
+
+
+_sizers = {}
+_sizers_lock = threading.Lock()
+
+
+def get_num_ctx_sizer(model):
+    """获取指定模型的 num_ctx 档位选择器，同一模型在进程内共享"""
+    with _sizers_lock:
+        sizer = _sizers.get(model)
+        if sizer is None:
+            sizer = _sizers[model] = NumCtxSizer()
+        return sizer
+
+
+def startup_num_ctx(model, fields, mode):
+    """
+    还没有具体请求时（如 start_web.py 启动时预热）按生成模式提升模型的 num_ctx 档位：
+    至少能容纳单个请求的输出预留，structured 一次生成全部字段，其余模式每次一个字段；
+    提示词的长度要到批量计划时才能确定，届时档位可能继续提升，批量生成前会再按新档位预热
+    :param model: 模型名称
+    :param fields: 该模型负责生成的字段
+    :param mode: 生成模式
+    :return: num_ctx
+    """
+    if mode == "structured":
+        reserve = output_tokens(fields)
+    else:
+        reserve = max((output_tokens(field) for field in fields), default=0)
+    num_ctx, _ = get_num_ctx_sizer(model).pick(0, reserve)
+    return num_ctx
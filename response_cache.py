@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 不影响生成结果的请求字段，不参与缓存键计算
+NON_KEY_FIELDS = {"stream", "keep_alive"}
+
+
+class ResponseCache:
+    """LLM响应磁盘缓存：以提示词、模型和生成参数的哈希为键，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        """
+        :param cache_dir: 缓存根目录，默认 Config.CACHE_DIR
+        :param max_bytes: 缓存总大小上限（字节），默认 Config.CACHE_MAX_MB
+        """
+        self.root = os.path.join(cache_dir or Config.CACHE_DIR, "responses")
+        self.max_bytes = max_bytes if max_bytes is not None else Config.CACHE_MAX_MB * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # 键 -> 文件大小，按最近使用时间从旧到新排列
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._load_index()
+
+    @staticmethod
+    def make_key(payload):
+        """
+        计算请求的缓存键
+        :param payload: 发往Ollama的请求数据
+        :return: sha256 十六进制字符串
+        """
+        material = {k: v for k, v in payload.items() if k not in NON_KEY_FIELDS}
+        # num_ctx 只决定上下文窗口大小，提示词能完整放入时不影响生成结果
+        if "num_ctx" in material.get("options", {}):
+            material["options"] = {k: v for k, v in material["options"].items() if k != "num_ctx"}
+        encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _load_index(self):
+        """扫描磁盘上已有的缓存条目，按修改时间恢复使用顺序"""
+        found = []
+        if os.path.isdir(self.root):
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if not filename.endswith(".json"):
+                        continue
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    found.append((stat.st_mtime, filename[:-5], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        if found:
+            logger.info(f"响应缓存已加载 {len(found)} 条，共 {self._total_bytes / 1024:.1f} KB")
+
+    def get(self, key):
+        """
+        读取缓存
+        :param key: 缓存键
+        :return: 缓存的响应字典，未命中返回None
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    value = json.load(f)
+                # 刷新修改时间，重启后仍能恢复最近使用顺序
+                os.utime(path)
+            except (OSError, json.JSONDecodeError):
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        写入缓存，超出容量时淘汰最久未使用的条目
+        :param key: 缓存键
+        :param value: 可JSON序列化的响应字典
+        """
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        with self._lock:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+            self._total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            while self._total_bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def _drop(self, key):
+        """删除条目（调用方持有锁）"""
+        self._total_bytes -= self._entries.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def invalidate(self, key):
+        """
+        删除指定缓存条目
+        :return: 条目是否存在
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._drop(key)
+            return True
+
+    def clear(self):
+        """清空全部缓存"""
+        with self._lock:
+            for key in list(self._entries):
+                self._drop(key)
+
+    def stats(self):
+        """命中率和容量统计"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    """进程内共享的响应缓存；CACHE_ENABLED 关闭时返回None"""
+    global _cache
+    if not Config.CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
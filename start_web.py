@@ -48,6 +48,32 @@ def check_ollama():
     print("3. 下载模型: ollama pull qwen3:1.7b")
     return False
 
+def warm_up_ollama():
+    """预热模型（OLLAMA_WARMUP），第一次生成时无需等待模型加载"""
+    from config import Config
+    from ollama_client import awarm_up_model, run_sync, OllamaError
+    from prompt_budget import startup_num_ctx
+    from ai_generator import LESSON_FIELDS
+    
+    if not Config.OLLAMA_WARMUP:
+        return
+    # 按生成模式和字段路由确定每个模型的 num_ctx，与生成时的档位选择一致
+    mode = Config.get_generation_mode()
+    routes = Config.get_field_models()
+    fields = {}
+    for field in LESSON_FIELDS:
+        model = Config.OLLAMA_MODEL if mode == "structured" else routes.get(field, Config.OLLAMA_MODEL)
+        fields.setdefault(model, []).append(field)
+    for host in Config.get_ollama_hosts():
+        for model, model_fields in fields.items():
+            num_ctx = startup_num_ctx(model, model_fields, mode)
+            print(f"正在预热模型 {model} ({host}, num_ctx={num_ctx})...")
+            try:
+                seconds = run_sync(awarm_up_model(host, model, num_ctx=num_ctx))
+                print(f"模型预热完成，加载耗时 {seconds:.2f}s")
+            except OllamaError as e:
+                print(f"警告: 模型预热失败: {e}")
+
 def create_directories():
     """创建必要的目录"""
     directories = [
@@ -100,6 +126,8 @@ def main():
     
     # 检查Ollama
     ollama_running = check_ollama()
+    if ollama_running:
+        warm_up_ollama()
     
     print("\n" + "=" * 50)
     print("启动信息:")
@@ -0,0 +1,157 @@
+import re
+import math
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from config import Config
+from prompt_budget import estimate_tokens
+
+try:
+    import jieba
+    jieba.setLogLevel(logging.WARNING)
+except ImportError:
+    jieba = None
+
+logger = logging.getLogger(__name__)
+
+_CJK_RUN = re.compile(r"[\u4e00-\u9fff]+")
+_WORD = re.compile(r"[A-Za-z0-9]+")
+
+# BM25 参数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """
+    中文分词：安装了 jieba 时使用搜索引擎模式分词，否则把连续的汉字切成相邻两字的组合
+    英文和数字按单词切分并转为小写
+    :param text: 文本
+    :return: 词列表
+    """
+    terms = [word.lower() for word in _WORD.findall(text)]
+    for run in _CJK_RUN.findall(text):
+        if jieba is not None:
+            terms.extend(word for word in jieba.lcut_for_search(run) if word.strip())
+        elif len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+
+class SyllabusIndex:
+    """教学大纲检索索引：段落合并为片段，按 BM25 为每节课挑选最相关的片段"""
+
+    def __init__(self, paragraphs, chunk_chars=None):
+        """
+        :param paragraphs: 大纲段落列表
+        :param chunk_chars: 片段的目标字数，较短的相邻段落会合并，默认 Config.SYLLABUS_CHUNK_CHARS
+        """
+        self.chunks = self._chunk(paragraphs, chunk_chars or Config.SYLLABUS_CHUNK_CHARS)
+        self.postings = {}
+        self.lengths = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            counts = Counter(tokenize(chunk))
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, []).append((chunk_id, tf))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.idf = {
+            term: math.log(1 + (len(self.chunks) - len(posting) + 0.5) / (len(posting) + 0.5))
+            for term, posting in self.postings.items()
+        }
+        self._selections = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chunk(paragraphs, chunk_chars):
+        """把相邻的短段落合并成不超过 chunk_chars 字的片段，超长段落单独成段"""
+        chunks, current = [], ""
+        for paragraph in paragraphs:
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if current and len(current) + len(paragraph) + 1 > chunk_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n{paragraph}" if current else paragraph
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def search(self, query):
+        """
+        BM25 检索
+        :param query: 查询文本
+        :return: [(得分, 片段序号), ...]，按得分从高到低，不含零分片段
+        """
+        scores = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for chunk_id, tf in self.postings[term]:
+                norm = 1 - BM25_B + BM25_B * self.lengths[chunk_id] / self.avg_length
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+        return sorted(((score, chunk_id) for chunk_id, score in scores.items()), reverse=True)
+
+    def select(self, query, token_budget=None):
+        """
+        在token预算内挑选与查询最相关的片段，同一查询只计算一次
+        :param query: 查询文本（一般为章节内容）
+        :param token_budget: token预算，默认 Config.SYLLABUS_CONTEXT_TOKENS
+        :return: 按原文顺序拼接的片段文本，没有相关内容时为空字符串
+        """
+        budget = token_budget if token_budget is not None else Config.SYLLABUS_CONTEXT_TOKENS
+        key = (query, budget)
+        with self._lock:
+            if key in self._selections:
+                return self._selections[key]
+
+        chosen, seen, used = [], set(), 0
+        for _, chunk_id in self.search(query):
+            text = self.chunks[chunk_id]
+            cost = estimate_tokens(text)
+            # 大纲中重复出现的内容只取一次
+            if text in seen or used + cost > budget:
+                continue
+            chosen.append(chunk_id)
+            seen.add(text)
+            used += cost
+        excerpt = "\n".join(self.chunks[chunk_id] for chunk_id in sorted(chosen))
+        logger.debug(f"大纲检索 '{query}': 选中 {len(chosen)} 个片段，约 {used} tokens")
+
+        with self._lock:
+            self._selections[key] = excerpt
+        return excerpt
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+# 进程内保留的大纲索引数量
+_MAX_INDEXES = 8
+
+
+def get_syllabus_index(syllabus_data):
+    """
+    获取教学大纲的检索索引，同一份大纲（按内容哈希）只构建一次
+    :param syllabus_data: DataParser.parse_syllabus 的返回值
+    :return: SyllabusIndex，大纲为空时返回None
+    """
+    if not syllabus_data or not syllabus_data.get('paragraphs'):
+        return None
+    digest = hashlib.sha1("\n".join(syllabus_data['paragraphs']).encode("utf-8")).hexdigest()
+    # 持锁构建，多个字段线程同时请求时只构建一次
+    with _indexes_lock:
+        index = _indexes.get(digest)
+        if index is not None:
+            _indexes.move_to_end(digest)
+            return index
+        index = SyllabusIndex(syllabus_data['paragraphs'])
+        logger.info(f"已为教学大纲构建检索索引: {len(index.chunks)} 个片段，{len(index.postings)} 个词项")
+        _indexes[digest] = index
+        while len(_indexes) > _MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
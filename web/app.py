@@ -2,7 +2,7 @@ from fastapi import FastAPI, File, UploadFile, HTTPException, WebSocket, WebSock
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.requests import Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
@@ -32,7 +32,12 @@ print(f"当前工作目录: {os.getcwd()}")
 
 from data_parser import DataParser
 from ai_generator import AIGenerator
-from document_builder import DocumentBuilder
+from document_builder import DocumentBuilder, get_compiled_template
+from batch_generator import BatchGenerator
+from response_cache import get_response_cache
+from ollama_client import host_health
+import metrics
+from config import Config
 
 # Pydantic模型
 class ParseRequest(BaseModel):
@@ -43,6 +48,8 @@ class GenerateRequest(BaseModel):
     syllabus_file_id: str = None
     template_file_id: str = None
     week_range: str = None
+    use_cache: bool = True
+    refresh_cache: bool = False
 
 app = FastAPI(title="教案AI生成器", description="高职院校教案智能生成系统")
 
@@ -79,20 +86,48 @@ websocket_connections: List[WebSocket] = []
 class ConnectionManager:
     def __init__(self):
         self.active_connections: List[WebSocket] = []
+        # 节流消息的上次发送时间
+        self._last_sent: Dict[str, float] = {}
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
         self.active_connections.append(websocket)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        # 发送失败时 broadcast 可能已经移除了该连接
+        if websocket in self.active_connections:
+            self.active_connections.remove(websocket)
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
         await websocket.send_text(message)
 
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        """
+        向所有连接广播消息；发送失败的连接（如浏览器已关闭）直接移除，
+        不把异常抛给调用方，字段进度在流式生成过程中广播，浏览器断开不能导致课次生成失败
+        """
+        for connection in list(self.active_connections):
+            try:
+                await connection.send_text(message)
+            except Exception as e:
+                print(f"WebSocket发送失败，移除连接: {e}")
+                self.disconnect(connection)
+
+    async def broadcast_throttled(self, key: str, message: str, force: bool = False):
+        """同一key的消息在 STREAM_PROGRESS_INTERVAL 秒内最多广播一次，force 的消息总是发送"""
+        now = time.monotonic()
+        if not force and now - self._last_sent.get(key, 0) < Config.STREAM_PROGRESS_INTERVAL:
+            return
+        if force:
+            self._last_sent.pop(key, None)
+        else:
+            self._last_sent[key] = now
+        await self.broadcast(message)
+
+    def clear_throttled(self, prefix: str):
+        """清除以 prefix 开头的节流记录（任务结束时调用，失败或终止的流式字段不会发送 done 消息）"""
+        for key in [key for key in self._last_sent if key.startswith(prefix)]:
+            del self._last_sent[key]
 
 manager = ConnectionManager()
 
@@ -163,14 +198,26 @@ async def upload_template(file: UploadFile = File(...)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"文件保存失败: {str(e)}")
     
+    # 上传时编译一次模板，得到占位符清单；生成任务复用编译结果，只生成模板中用到的字段
+    try:
+        template = await asyncio.to_thread(get_compiled_template, file_path)
+    except Exception as e:
+        os.remove(file_path)
+        raise HTTPException(status_code=400, detail=f"教案模板无法解析: {str(e)}")
+    inventory = template.inventory()
+    print(f"模板 {file.filename}: 生成字段 {inventory['fields']}，跳过 {inventory['skipped_fields']}")
+    if inventory["unknown"]:
+        print(f"模板 {file.filename} 中以下占位符无法填充: {inventory['unknown']}")
+    
     uploaded_files[file_id] = {
         "filename": file.filename,
         "filepath": file_path,
         "type": "template",
-        "status": "uploaded"
+        "status": "uploaded",
+        "inventory": inventory
     }
     
-    return {"file_id": file_id, "filename": file.filename, "status": "success"}
+    return {"file_id": file_id, "filename": file.filename, "status": "success", "inventory": inventory}
 
 @app.get("/api/files")
 async def get_files():
@@ -261,7 +308,7 @@ async def parse_file(file_type: str, request: ParseRequest):
         if file_type == "schedule":
             # 处理Excel教学进度表
             print("  步骤1: 验证Excel文件结构...")
-            validation_result = DataParser.validate_excel_structure(file_info["filepath"])
+            validation_result = await asyncio.to_thread(DataParser.validate_excel_structure, file_info["filepath"])
             
             print(f"  验证结果: {validation_result}")
             if not validation_result["valid"]:
@@ -276,7 +323,7 @@ async def parse_file(file_type: str, request: ParseRequest):
                 }
             
             print("  步骤2: 解析Excel文件内容...")
-            schedule_data = DataParser.parse_schedule(file_info["filepath"])
+            schedule_data = await asyncio.to_thread(DataParser.parse_schedule, file_info["filepath"])
             
             print(f"  ✓ 解析成功，共 {len(schedule_data)} 条记录")
             uploaded_files[file_id]["parsed_data"] = schedule_data
@@ -291,7 +338,7 @@ async def parse_file(file_type: str, request: ParseRequest):
         elif file_type == "syllabus":
             # 处理Word教学大纲
             print("  步骤1: 解析Word教学大纲...")
-            syllabus_data = DataParser.parse_syllabus(file_info["filepath"])
+            syllabus_data = await asyncio.to_thread(DataParser.parse_syllabus, file_info["filepath"])
             
             word_count = syllabus_data.get('word_count', 0)
             paragraph_count = syllabus_data.get('paragraph_count', 0)
@@ -309,7 +356,7 @@ async def parse_file(file_type: str, request: ParseRequest):
         elif file_type == "template":
             # 处理Word教案模板
             print("  步骤1: 解析Word教案模板...")
-            template_data = DataParser.parse_syllabus(file_info["filepath"])
+            template_data = await asyncio.to_thread(DataParser.parse_syllabus, file_info["filepath"])
             
             word_count = template_data.get('word_count', 0)
             paragraph_count = template_data.get('paragraph_count', 0)
@@ -497,7 +544,8 @@ async def generate_lesson_plans(request: GenerateRequest):
     
     # 启动后台生成任务
     asyncio.create_task(generate_lesson_plans_background(
-        task_id, request.schedule_file_id, request.syllabus_file_id, request.template_file_id, request.week_range
+        task_id, request.schedule_file_id, request.syllabus_file_id, request.template_file_id, request.week_range,
+        request.use_cache, request.refresh_cache
     ))
     
     return {"task_id": task_id, "status": "started"}
@@ -507,7 +555,9 @@ async def generate_lesson_plans_background(
     schedule_file_id: str,
     syllabus_file_id: str = None,
     template_file_id: str = None,
-    week_range: str = None
+    week_range: str = None,
+    use_cache: bool = True,
+    refresh_cache: bool = False
 ):
     print(f"=== 后台生成任务开始 ===")
     print(f"task_id: {task_id}")
@@ -555,8 +605,9 @@ async def generate_lesson_plans_background(
             "current": ""
         }))
         
-        schedule_data = DataParser.parse_schedule(schedule_file)
-        syllabus_data = DataParser.parse_syllabus(syllabus_file) if syllabus_file else None
+        # 解析放到线程中执行，避免阻塞事件循环
+        schedule_data = await asyncio.to_thread(DataParser.parse_schedule, schedule_file)
+        syllabus_data = await asyncio.to_thread(DataParser.parse_syllabus, syllabus_file) if syllabus_file else None
         
         # 应用周次范围过滤
         if week_range:
@@ -578,14 +629,15 @@ async def generate_lesson_plans_background(
         
         print("正在初始化AI生成器...")
         try:
-            ai_generator = AIGenerator()
+            ai_generator = await asyncio.to_thread(AIGenerator)
             print("AI生成器初始化成功")
         except Exception as e:
             print(f"AI生成器初始化失败: {e}")
             raise
         
         try:
-            doc_builder = DocumentBuilder(template_file)
+            # 模板按内容哈希在进程内共享，同一模板只在第一个任务中解析
+            doc_builder = await asyncio.to_thread(DocumentBuilder, template_file)
             print("文档生成器初始化成功")
         except Exception as e:
             print(f"文档生成器初始化失败: {e}")
@@ -595,51 +647,99 @@ async def generate_lesson_plans_background(
         total_lessons = len(schedule_data)
         generation_tasks[task_id]["total"] = total_lessons
         
-        # 生成教案
-        output_dir = "lesson_plans"
-        os.makedirs(output_dir, exist_ok=True)
+        # 生成教案：多节课流水线并发，AI请求走异步客户端，生成完的课立即渲染；模板中没有占位符的字段不生成
+        batch = BatchGenerator(ai_generator, doc_builder, output_dir="lesson_plans",
+                               use_cache=use_cache, refresh_cache=refresh_cache)
+        generation_tasks[task_id]["fields"] = batch.fields
+        generation_tasks[task_id]["skipped_fields"] = batch.skipped_fields
+        print(f"批量生成: 课次并发 {batch.lesson_concurrency}，字段并发 {ai_generator.field_concurrency}")
+        if batch.skipped_fields:
+            print(f"模板中没有以下字段的占位符，跳过生成: {batch.skipped_fields}")
         
-        for i, lesson_data in enumerate(schedule_data):
-            # 检查任务是否仍然存在
-            if task_id not in generation_tasks:
-                print(f"任务 {task_id} 已被删除，停止生成")
-                break
-            
-            # 更新当前进度信息
-            current_lesson = f"第{lesson_data['week']}周第{lesson_data['lesson']}次课"
-            generation_tasks[task_id]["current"] = current_lesson
+        async def on_event(event):
+            task = generation_tasks.get(task_id)
+            if task is None:
+                return
             
-            progress = 20 + int((i / total_lessons) * 70)
-            generation_tasks[task_id]["progress"] = progress
+            if event["type"] == "lesson_started":
+                task["current"] = event["lesson"]
+                message = f"正在生成{event['lesson']}教案..."
+            elif event["type"] == "lesson_completed":
+                task["result_files"].append(event["filename"])
+                message = f"已生成: {event['filename']}"
+            elif event["type"] == "lesson_failed":
+                task.setdefault("failed_lessons", []).append({"lesson": event["lesson"], "error": event["error"]})
+                message = f"{event['lesson']}生成失败: {event['error']}"
+            elif event["type"] == "backend_unavailable":
+                message = f"Ollama服务暂不可用，批量生成已暂停，约{event['retry_after']:.0f}秒后重试{event['lesson']}"
+            else:
+                return
             
-            # 广播进度更新
-            progress_message = json.dumps({
+            task["progress"] = 20 + int((event["done"] / total_lessons) * 70)
+            print(message)
+            await manager.broadcast(json.dumps({
                 "type": "progress",
                 "task_id": task_id,
-                "status": "running",
-                "progress": progress,
-                "message": f"正在生成{current_lesson}教案...",
-                "current": current_lesson
-            })
-            print(f"广播进度消息: {progress_message}")
-            await manager.broadcast(progress_message)
-            
-            # 生成AI内容
-            ai_content = {}
-            for field in ["单元教学目标", "教学重点", "教学难点", "教学活动", "作业布置", "教学资源", "教学反思", "教学评价"]:
-                print(f"=== 生成 {field} ===")
-                print(f"lesson_data: {lesson_data}")
-                print(f"lesson_data keys: {lesson_data.keys() if isinstance(lesson_data, dict) else 'Not a dict'}")
-                ai_content[field] = ai_generator.generate_content(field, lesson_data=lesson_data, syllabus_data=syllabus_data)
-            
-            # 生成文档
-            output_filename = f"第{lesson_data['week']}周第{lesson_data['lesson']}次课教案.docx"
-            output_path = os.path.join(output_dir, output_filename)
-            
-            doc_builder.build_lesson_plan(lesson_data, ai_content, output_path)
-            generation_tasks[task_id]["result_files"].append(output_filename)
-            
-            print(f"已生成: {output_filename}")
+                "status": task["status"],
+                "progress": task["progress"],
+                "message": message,
+                "current": event["lesson"]
+            }))
+        
+        async def on_field_progress(event):
+            # 流式生成时的字段级进度，按字段节流后推送
+            task = generation_tasks.get(task_id)
+            if task is None:
+                return
+            if event["ttft"] is not None and "first_token_latency" not in task:
+                task["first_token_latency"] = round(event["ttft"], 3)
+                print(f"首个token耗时: {event['ttft']:.2f}s ({event['lesson']} {event['field']})")
+            await manager.broadcast_throttled(
+                f"{task_id}:{event['lesson']}:{event['field']}",
+                json.dumps({
+                    "type": "field_progress",
+                    "task_id": task_id,
+                    "lesson": event["lesson"],
+                    "field": event["field"],
+                    "chars": event["chars"],
+                    "preview": event["preview"],
+                    "ttft": event["ttft"],
+                    "done": event["done"],
+                    "cached": event.get("cached", False)
+                }),
+                force=event["done"]
+            )
+        
+        def should_stop():
+            return task_id not in generation_tasks or generation_tasks[task_id]["status"] == "stopped"
+        
+        def should_pause():
+            return generation_tasks.get(task_id, {}).get("status") == "paused"
+        
+        batch_result = await batch.arun(schedule_data, syllabus_data, on_event=on_event,
+                                        should_stop=should_stop, should_pause=should_pause,
+                                        on_field_progress=on_field_progress)
+        
+        if task_id not in generation_tasks:
+            print(f"任务 {task_id} 已被删除，停止生成")
+            return
+        generation_tasks[task_id]["lessons_per_minute"] = round(batch_result["lessons_per_minute"], 2)
+        # 模型在批量计划之后预热
+        if ai_generator.model_load_seconds is not None:
+            generation_tasks[task_id]["model_load_seconds"] = round(ai_generator.model_load_seconds, 3)
+        generation_tasks[task_id]["batch_model_load_seconds"] = round(batch_result["model_load_seconds"], 3)
+        if ai_generator.generation_mode == "prefix":
+            generation_tasks[task_id]["prompt_tokens_saved"] = batch_result["prompt_tokens_saved"]
+        if batch_result.get("plan"):
+            generation_tasks[task_id]["dedup"] = dict(batch_result["plan"],
+                                                      deduplicated=batch_result["requests_deduplicated"])
+        generation_tasks[task_id]["field_generations_skipped"] = batch_result["field_generations_skipped"]
+        generation_tasks[task_id]["field_usage"] = ai_generator.field_usage_report()
+        if ai_generator.cache is not None:
+            generation_tasks[task_id]["cache"] = ai_generator.cache.stats()
+        if batch_result["stopped"]:
+            print(f"任务 {task_id} 已终止，共生成 {len(batch_result['completed'])} 个教案")
+            return
         
         # 完成生成
         generation_tasks[task_id]["status"] = "completed"
@@ -674,6 +774,8 @@ async def generate_lesson_plans_background(
         })
         print(f"广播错误消息: {error_message}")
         await manager.broadcast(error_message)
+    finally:
+        manager.clear_throttled(f"{task_id}:")
 
 @app.get("/api/generate/status/{task_id}")
 async def get_generation_status(task_id: str):
@@ -947,6 +1049,36 @@ async def resume_generation_background(task_id: str):
             "message": f"生成失败: {str(e)}"
         }))
 
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    cache = get_response_cache()
+    if cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **cache.stats()}
+
+@app.delete("/api/cache")
+async def clear_cache():
+    cache = get_response_cache()
+    if cache is None:
+        return {"status": "disabled"}
+    await asyncio.to_thread(cache.clear)
+    return {"status": "success"}
+
+@app.get("/api/ollama/hosts")
+async def get_ollama_hosts():
+    # 各Ollama主机的熔断状态和在途请求数；尚未发过请求的主机没有记录
+    health = {item["host"]: item for item in host_health()}
+    hosts = [health.get(host, {"host": host, "state": "unknown"}) for host in Config.get_ollama_hosts()]
+    return {"hosts": hosts}
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus 文本格式：按字段、模型和Ollama主机统计的耗时直方图、token数和生成速度
+    for item in host_health():
+        metrics.BACKEND_OUTSTANDING.set(item["outstanding"], backend=item["host"])
+        metrics.BACKEND_BREAKER_OPEN.set(int(item["state"] != "closed"), backend=item["host"])
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/api/generate/results")
 async def get_generation_results():
     results = []
@@ -92,11 +92,31 @@ function handleWebSocketMessage(data) {
     
     if (data.type === 'progress') {
         updateProgress(data);
+    } else if (data.type === 'field_progress') {
+        updateFieldProgress(data);
     } else {
         console.log('未知消息类型:', data.type);
     }
 }
 
+// 更新字段级流式进度
+function updateFieldProgress(data) {
+    if (data.task_id && data.task_id !== currentTaskId) {
+        return;
+    }
+    
+    const progressCurrent = document.getElementById('progress-current');
+    if (progressCurrent) {
+        const state = data.done ? '完成' : '生成中';
+        progressCurrent.textContent = `${data.lesson} · ${data.field}：${state}，已生成 ${data.chars} 字`;
+        progressCurrent.title = data.preview || '';
+    }
+    
+    if (data.done && !data.cached && data.ttft !== null) {
+        addLogEntry(`${data.lesson} ${data.field} 生成完成（首字耗时 ${data.ttft.toFixed(2)} 秒，共 ${data.chars} 字）`);
+    }
+}
+
 // 文件拖拽处理
 function handleDragOver(event) {
     event.preventDefault();
@@ -216,6 +236,16 @@ async function uploadFile(file, fileType) {
         placeholder.classList.remove('d-none');
         
         addLogEntry(`${getFileTypeName(fileType)}上传成功: ${file.name}`, 'success');
+        if (result.inventory) {
+            // 模板中没有占位符的字段不会生成
+            addLogEntry(`模板使用的字段: ${result.inventory.fields.join('、') || '无'}`, 'info');
+            if (result.inventory.skipped_fields.length > 0) {
+                addLogEntry(`模板中没有占位符，跳过生成: ${result.inventory.skipped_fields.join('、')}`, 'warning');
+            }
+            if (result.inventory.unknown.length > 0) {
+                addLogEntry(`模板中无法填充的占位符: ${result.inventory.unknown.join('、')}`, 'warning');
+            }
+        }
         updateUploadedFilesList();
         updateGenerateButton();
         